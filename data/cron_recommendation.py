@@ -1,18 +1,18 @@
 from recommedation_algo.recommender import Recommender
-from apscheduler.schedulers.blocking import BlockingScheduler
+from recommedation_algo.store import NeighbourStore
+from recommedation_algo.listener import RecommendationListener
+from recommedation_algo import metrics
 
 import logging
+import os
 import warnings
 
 
 def run():
-    scheduler = BlockingScheduler()
-    recommender = Recommender()
+    recommender = Recommender(NeighbourStore(), workers=os.cpu_count(), metrics_path=metrics.DEFAULT_PATH)
 
-    # cron for cinema schedule, run at 0:00 everyday
-    scheduler.add_job(recommender.update_user_recommendations,
-                      trigger='interval', seconds=30)
-    scheduler.start()
+    # recompute users as their ratings change, with a periodic full sweep
+    RecommendationListener(recommender).run()
 
 
 if __name__ == '__main__':
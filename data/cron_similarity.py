@@ -2,6 +2,12 @@ from recommedation_algo import similarity
 from apscheduler.schedulers.blocking import BlockingScheduler
 
 import logging
+import os
+
+
+def update(ms, options):
+    ms.calculate_similarity_table(**options)
+    ms.publish_neighbour_store()
 
 
 def run():
@@ -10,7 +16,12 @@ def run():
     scheduler = BlockingScheduler()
 
     # cron for cinema schedule, run at 0:00 everyday
-    scheduler.add_job(ms.calculate_similarity_table, trigger='interval', days=1)
+    options = {
+        'incremental': True,
+        'top_k': ms.NEIGHBOUR_COUNT,
+        'workers': os.cpu_count()
+    }
+    scheduler.add_job(update, args=[ms, options], trigger='interval', days=1)
     scheduler.start()
 
 if __name__ == '__main__':
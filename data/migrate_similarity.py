@@ -0,0 +1,27 @@
+"""
+    one-off online migration of the similarity table to one row per
+    pair (id_1 < id_2), run while the recommender keeps serving
+"""
+from recommedation_algo.database import DatabaseHandler
+
+import logging
+import time
+
+
+def run(batch_size=10000, pause=0.1):
+    db = DatabaseHandler()
+    db.create_tables()
+    db.create_similarity_indexes()  # covering indexes for lookups from either side, built concurrently
+
+    moved_count = 0
+    for moved, last_key in db.migrate_similarity_pairs(batch_size):
+        moved_count += moved
+        logging.info(str(moved_count) + " pairs moved, at " + str(last_key))
+        time.sleep(pause)  # leave room for the regular workload
+
+    db.validate_similarity_pairs()
+    logging.info("migration complete, " + str(moved_count) + " pairs moved.")
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    run()
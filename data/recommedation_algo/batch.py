@@ -0,0 +1,139 @@
+"""
+    recommendations for all users in one pass
+"""
+from recommedation_algo.recommender import Recommender
+from recommedation_algo.regression import fit_batch_least_squares, predict_scores
+from datetime import datetime, timedelta
+
+import heapq
+import logging
+import numpy
+
+
+class BatchRecommender(Recommender):
+    """
+        produces the same recommendations as Recommender, but loads user
+        ratings, public ratings and neighbour lists for everyone with a few
+        bulk queries, scores every (user, candidate) pair with vectorized
+        numpy operations, and writes all recommendations in one upsert
+    """
+
+    SOURCE_COUNT = 3  # IMDb, Douban and Trakt
+
+    def update_user_recommendations(self, user_ids=None):
+        """
+        generate and store recommendations of every user whose
+        recommendations may have changed since the last run
+        :param user_ids: collection of user ids, only these users are considered if given
+        :return: None
+        """
+        logging.info("initialise batch recommending process ...")
+        self.metrics.reset()
+        considered = len(self.db.get_users() if user_ids is None else user_ids)
+        dirty_users = self.db.get_dirty_users(self.USER_RATINGS_CRITERION, user_ids, self.store is not None)
+        user_ids = [state[0] for state in dirty_users]
+        skipped = considered - len(user_ids)
+        if not user_ids:
+            logging.info("no user to recompute, " + str(skipped) + " unchanged users skipped.")
+            return
+
+        with self.metrics.stage('seeds'):
+            histories = {}
+            recomputed = set(user_ids)
+            for user_id, movie_id, score in self.db.get_all_user_history():
+                if user_id in recomputed:
+                    histories.setdefault(user_id, []).append((movie_id, score))
+            seeds = {user_id: self._generate_recommend_seeds(histories.get(user_id, [])) for user_id in user_ids}
+
+        with self.metrics.stage('neighbours'):
+            neighbours = self._get_neighbour_lists(set(seed for user_seeds in seeds.values() for seed in user_seeds))
+            candidates = {user_id: set(movie_id for seed in user_seeds for movie_id in neighbours.get(seed, []))
+                          for user_id, user_seeds in seeds.items()}
+
+        with self.metrics.stage('scoring'):
+            public_ratings = self.db.get_public_rating_vectors(list(set().union(*candidates.values())))
+            self._enqueue_stale_ratings(public_ratings, candidates)
+
+            training = self.db.get_scale_training_data(user_ids)
+            recommendations = self.recommend(user_ids, training, candidates, public_ratings)
+
+        rows = [(user_id, movie_id, score)
+                for user_id, recommend_list in recommendations.items() for movie_id, score in recommend_list]
+        self.db.save_all_recommendations(rows, user_ids)
+        self.db.save_recommendation_state(dirty_users)
+        logging.info(str(len(rows)) + " recommendations stored for " + str(len(user_ids)) + " users, " +
+                     str(skipped) + " unchanged users skipped.")
+        self._report_metrics()
+
+    def recommend(self, user_ids, training, candidates, public_ratings):
+        """
+        score the candidates of every user
+        :param user_ids: list
+        :param training: tuple, as returned by DatabaseHandler.get_scale_training_data
+        :param candidates: dictionary, user id -> set of movie ids
+        :param public_ratings: dictionary, as returned by DatabaseHandler.get_public_rating_vectors
+        :return: dictionary, user id -> list of [movie id, predicted score]
+        """
+        vectors = {movie_id: ratings['scores'] for movie_id, ratings in public_ratings.items()
+                   if ratings['count'] == self.SOURCE_COUNT}
+
+        positions = {user_id: position for position, user_id in enumerate(user_ids)}
+        users, regressors, responses = training
+        coefficients, intercepts, fitted = fit_batch_least_squares(
+            numpy.array([positions[user_id] for user_id in users.tolist()], dtype=numpy.int64),
+            regressors, responses, len(user_ids)
+        )
+
+        pair_users = []
+        pair_movies = []
+        for position, user_id in enumerate(user_ids):
+            for movie_id in candidates.get(user_id, []):
+                if movie_id in vectors:
+                    pair_users.append(position)
+                    pair_movies.append(movie_id)
+
+        recommendations = {user_id: [] for user_id in user_ids}
+        if not pair_movies:
+            return recommendations
+
+        pair_users = numpy.array(pair_users)
+        regressors = numpy.array([vectors[movie_id] for movie_id in pair_movies], dtype=numpy.float64)
+        scores = predict_scores(regressors, coefficients[pair_users], intercepts[pair_users], fitted[pair_users])
+
+        kept = (scores <= self.ANOMALY_CRITERION) & (scores > self.RECOMMEND_CRITERION)
+        for pair in numpy.flatnonzero(kept):
+            recommendations[user_ids[pair_users[pair]]].append([pair_movies[pair], float(scores[pair])])
+        return {user_id: heapq.nlargest(self.limit, recommend_list, key=lambda recommendation: recommendation[1])
+                for user_id, recommend_list in recommendations.items()}
+
+    def _get_neighbour_lists(self, seed_ids):
+        """
+        :param seed_ids: set of movie ids
+        :return: dictionary, seed id -> list of neighbour ids
+        """
+        if self.store is not None and self.store.refresh():
+            return {seed_id: self.store.get_neighbours([seed_id], self.NEIGHBOUR_CRITERION) for seed_id in seed_ids}
+
+        neighbours = {}
+        for seed_id, (neighbour_ids, scores) in self.db.get_neighbour_lists(list(seed_ids)).items():
+            neighbours[seed_id] = [neighbour_id for neighbour_id, score in zip(neighbour_ids, scores)
+                                   if score >= self.NEIGHBOUR_CRITERION]
+        return neighbours
+
+    def _enqueue_stale_ratings(self, public_ratings, candidates):
+        """
+        queue candidate ratings older than two days for re-extraction,
+        once per movie however many users it is a candidate for
+        :param public_ratings: dictionary, as returned by DatabaseHandler.get_public_rating_vectors
+        :param candidates: dictionary, user id -> set of movie ids
+        :return: None
+        """
+        outdated = datetime.now() - timedelta(days=2)
+        stale = [movie_id for movie_id in set().union(*candidates.values()) if movie_id in public_ratings and
+                 public_ratings[movie_id]['count'] == self.SOURCE_COUNT and
+                 public_ratings[movie_id]['updated_at'] < outdated]
+
+        if stale:
+            queued = self.refresh_queue.enqueue(stale)
+            self.metrics.increment('refreshes_queued', queued)
+            logging.debug(str(len(stale)) + " ratings may be outdated, " + str(queued) + " queued for re-extraction")
@@ -0,0 +1,190 @@
+"""
+    throughput benchmark of the similarity calculation, on synthetic
+    catalogs and without a database
+
+    usage: python -m recommedation_algo.benchmark --movies 2000 10000 --output results.json
+"""
+from recommedation_algo.similarity import MovieSimilarity
+
+import argparse
+import json
+import logging
+import numpy
+import resource
+import time
+
+
+def generate_catalog(size, seed=0, zipf_exponent=1.1):
+    """
+    synthetic movie rows; tokens are drawn with a zipf-like popularity,
+    a few genres, actors and directors appearing in many movies and most
+    of them in very few, like in the real catalog
+    :param size: integer, number of movies
+    :param seed: integer
+    :param zipf_exponent: float
+    :return: list of dictionaries, shaped like DatabaseHandler.get_movie_pool_object rows
+    """
+    generator = numpy.random.RandomState(seed)
+
+    def sampler(vocabulary_size, prefix):
+        weights = 1 / numpy.arange(1, vocabulary_size + 1) ** zipf_exponent
+        weights /= weights.sum()
+
+        def sample(count):
+            tokens = generator.choice(vocabulary_size, size=count, replace=False, p=weights)
+            return ", ".join(prefix + str(token) for token in tokens)
+        return sample
+
+    genres = sampler(25, 'Genre ')
+    actors = sampler(max(10, size * 2), 'Actor ')
+    directors = sampler(max(5, size // 3), 'Director ')
+
+    catalog = []
+    for index in range(size):
+        catalog.append({
+            'movie_id': 'tt' + str(index).zfill(7),
+            'genre': genres(generator.randint(1, 4)),
+            'actors': actors(generator.randint(2, 5)),
+            'director': directors(generator.randint(1, 3)),
+            'runtime': str(int(numpy.clip(generator.normal(100, 20), 60, 240)))
+        })
+    return catalog
+
+
+class InMemoryDatabaseHandler:
+    """
+        stand-in for DatabaseHandler with the methods used by the
+        similarity job, counting the write calls instead of storing pairs
+    """
+
+    def __init__(self, history, movie_pool):
+        self.history = history
+        self.movie_pool = movie_pool
+        self.scored_movie_ids = {}
+        self.neighbour_lists = {}
+        self.write_calls = 0
+        self.written_rows = 0
+
+    def create_tables(self):
+        pass
+
+    def get_user_history_object(self):
+        return self.history
+
+    def get_movie_pool_object(self):
+        return self.movie_pool
+
+    def get_scored_movie_ids(self, role):
+        return set(self.scored_movie_ids.get(role, set()))
+
+    def save_scored_movie_ids(self, movie_ids, role):
+        self.write_calls += 1
+        self.scored_movie_ids.setdefault(role, set()).update(movie_ids)
+
+    def get_similarity_writer(self, batch_size):
+        return InMemorySimilarityWriter(self, batch_size)
+
+    def get_neighbour_lists(self, movie_ids):
+        return {movie_id: self.neighbour_lists[movie_id] for movie_id in movie_ids if movie_id in self.neighbour_lists}
+
+    def get_all_neighbour_lists(self):
+        return dict(self.neighbour_lists)
+
+    def save_neighbour_lists(self, neighbour_lists):
+        self.write_calls += 1
+        self.written_rows += len(neighbour_lists)
+        for movie_id, neighbour_ids, scores in neighbour_lists:
+            self.neighbour_lists[movie_id] = (neighbour_ids, scores)
+
+
+class InMemorySimilarityWriter:
+    """
+        same batching as SimilarityWriter, a flush counts as one write
+    """
+
+    def __init__(self, db, batch_size):
+        self.db = db
+        self.batch_size = batch_size
+        self.buffered = 0
+
+    def add(self, movie_id_1, movie_id_2, similarity):
+        self.buffered += 1
+        if self.buffered >= self.batch_size:
+            self.flush()
+
+    def add_many(self, movie_id, neighbour_ids, similarities):
+        for neighbour_id, similarity in zip(neighbour_ids, similarities.tolist()):
+            self.add(movie_id, neighbour_id, similarity)
+
+    def flush(self):
+        if self.buffered:
+            self.db.write_calls += 1
+            self.db.written_rows += self.buffered
+            self.buffered = 0
+
+
+def run_benchmark(movie_count, history_count, min_score=None, top_k=None, batch_size=100000, seed=0):
+    """
+    time one similarity run on a synthetic catalog
+    :param movie_count: integer
+    :param history_count: integer, movies of the catalog rated by users
+    :param min_score: float or None
+    :param top_k: integer or None
+    :param batch_size: integer
+    :param seed: integer
+    :return: dictionary of results
+    """
+    catalog = generate_catalog(movie_count, seed)
+    history_rows = numpy.random.RandomState(seed).choice(movie_count, min(history_count, movie_count), replace=False)
+    db = InMemoryDatabaseHandler([catalog[row] for row in sorted(history_rows)], catalog)
+
+    similarity = MovieSimilarity(db)
+    started = time.time()
+    similarity.calculate_similarity_table(batch_size=batch_size, min_score=min_score, top_k=top_k)
+    elapsed = time.time() - started
+
+    pairs = len(history_rows) * movie_count
+    return {
+        'movies': movie_count,
+        'history': len(history_rows),
+        'min_score': min_score,
+        'top_k': top_k,
+        'pairs': pairs,
+        'seconds': round(elapsed, 4),
+        'pairs_per_second': round(pairs / elapsed, 1) if elapsed else None,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,  # process wide, only ever grows
+        'write_calls': db.write_calls,
+        'written_rows': db.written_rows
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="similarity calculation benchmark")
+    parser.add_argument('--movies', type=int, nargs='+', default=[1000, 5000], help="catalog sizes")
+    parser.add_argument('--history-ratio', type=float, default=0.1, help="share of the catalog rated by users")
+    parser.add_argument('--min-score', type=float, default=None)
+    parser.add_argument('--top-k', type=int, default=None)
+    parser.add_argument('--batch-size', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--label', default='', help="free text stored with the results, e.g. a version")
+    parser.add_argument('--output', default='similarity_benchmark.json')
+    arguments = parser.parse_args()
+
+    results = []
+    for movie_count in sorted(arguments.movies):  # smallest first, the peak rss is cumulative
+        result = run_benchmark(movie_count, int(movie_count * arguments.history_ratio), arguments.min_score,
+                               arguments.top_k, arguments.batch_size, arguments.seed)
+        logging.info(json.dumps(result))
+        results.append(result)
+
+    with open(arguments.output, 'w') as output:
+        json.dump({
+            'label': arguments.label,
+            'created_at': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'results': results
+        }, output, indent=2)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -1,17 +1,157 @@
 """handles all interactions with database"""
 import recommedation_algo.config as config
+from recommedation_algo.metrics import CountingCursor
 import datetime
+import io
+import json
+import numpy
 import psycopg2
+import select
 
 from psycopg2 import extras
 
+# tables owned by the recommendation algorithms, the rest is managed by the backend
+TABLES = [
+    "CREATE TABLE IF NOT EXISTS similarity ("
+    "id_1 VARCHAR(255) NOT NULL, "
+    "id_2 VARCHAR(255) NOT NULL, "
+    "similarity_value DOUBLE PRECISION, "
+    "PRIMARY KEY (id_1, id_2))",
+
+    "CREATE TABLE IF NOT EXISTS similarity_watermarks ("
+    "movie_id VARCHAR(255) NOT NULL, "
+    "role VARCHAR(16) NOT NULL, "
+    "scored_at TIMESTAMP NOT NULL DEFAULT now(), "
+    "PRIMARY KEY (movie_id, role))",
+
+    "CREATE TABLE IF NOT EXISTS similarity_neighbours ("
+    "movie_id VARCHAR(255) PRIMARY KEY, "
+    "neighbour_ids VARCHAR(255)[] NOT NULL, "
+    "scores REAL[] NOT NULL, "
+    "updated_at TIMESTAMP NOT NULL DEFAULT now(), "
+    "published_at TIMESTAMP)",
+
+    # version of the training set of each user scale, bumped by the notify triggers whenever a rating
+    # of the user, or the score of a movie they rated, changes. Users without a row are at version 0
+    "CREATE TABLE IF NOT EXISTS rating_versions ("
+    "user_id INTEGER PRIMARY KEY, "
+    "version BIGINT NOT NULL)",
+
+    # sufficient statistics X'X and X'y of the user scale regression, flattened, and the
+    # version of the training set they were built from
+    "CREATE TABLE IF NOT EXISTS scale_statistics ("
+    "user_id INTEGER PRIMARY KEY, "
+    "gram DOUBLE PRECISION[] NOT NULL, "
+    "moments DOUBLE PRECISION[] NOT NULL, "
+    "version BIGINT NOT NULL, "
+    "updated_at TIMESTAMP NOT NULL DEFAULT now())",
+
+    # when the recommendations of each user were last computed, and from which ratings
+    "CREATE TABLE IF NOT EXISTS recommendation_state ("
+    "user_id INTEGER PRIMARY KEY, "
+    "fingerprint VARCHAR(64) NOT NULL, "
+    "computed_at TIMESTAMP NOT NULL)"
+]
+
+# notifications of changed ratings, listened to by RecommendationListener, the triggers also bump
+# the rating versions. The triggers are on tables of the backend, so they are only created if
+# missing, by the listener
+NOTIFY_FUNCTIONS = [
+    # returns the new version of a single user. Users are bumped in order, for concurrent bumps
+    # of overlapping users not to deadlock
+    "CREATE OR REPLACE FUNCTION bump_rating_versions(user_ids INTEGER[]) RETURNS BIGINT AS $$ "
+    "DECLARE new_version BIGINT; BEGIN "
+    "WITH bumped AS (INSERT INTO rating_versions (user_id, version) "
+    "SELECT id, 1 FROM unnest(user_ids) id ORDER BY id "
+    "ON CONFLICT (user_id) DO UPDATE SET version = rating_versions.version + 1 RETURNING version) "
+    "SELECT max(version) INTO new_version FROM bumped; "
+    "RETURN new_version; END; $$ LANGUAGE plpgsql",
+
+    # score is null for a removed rating, old_score for an added one
+    "CREATE OR REPLACE FUNCTION notify_user_rating() RETURNS trigger AS $$ "
+    "DECLARE rating RECORD; new_score DOUBLE PRECISION; old_score DOUBLE PRECISION; BEGIN "
+    "IF TG_OP = 'DELETE' THEN rating := OLD; ELSE rating := NEW; new_score := NEW.score; END IF; "
+    "IF TG_OP <> 'INSERT' THEN old_score := OLD.score; END IF; "
+    "PERFORM pg_notify('user_ratings', json_build_object("
+    "'user_id', rating.user_id, 'movie_id', rating.movie_id, 'score', new_score, 'old_score', old_score, "
+    "'operation', TG_OP, 'version', bump_rating_versions(ARRAY[rating.user_id]))::text); "
+    "RETURN NULL; END; $$ LANGUAGE plpgsql",
+
+    "CREATE OR REPLACE FUNCTION notify_public_rating() RETURNS trigger AS $$ "
+    "DECLARE changed BOOLEAN := TG_OP = 'INSERT'; BEGIN "
+    "IF NOT changed THEN changed := OLD.score IS DISTINCT FROM NEW.score; END IF; "
+    "IF changed THEN "
+    "PERFORM bump_rating_versions(ARRAY(SELECT DISTINCT user_id FROM user_ratings WHERE movie_id = NEW.movie_id)); "
+    "END IF; "
+    "PERFORM pg_notify('public_ratings', NEW.movie_id); "
+    "RETURN NULL; END; $$ LANGUAGE plpgsql"
+]
+
+NOTIFY_TRIGGERS = {
+    'user_ratings_notify': "AFTER INSERT OR UPDATE ON user_ratings "
+                           "FOR EACH ROW EXECUTE PROCEDURE notify_user_rating()",
+    # a trigger of its own, existing triggers are never replaced
+    'user_ratings_delete_notify': "AFTER DELETE ON user_ratings FOR EACH ROW EXECUTE PROCEDURE notify_user_rating()",
+    'public_ratings_notify': "AFTER INSERT OR UPDATE ON public_ratings "
+                             "FOR EACH ROW EXECUTE PROCEDURE notify_public_rating()"
+}
+
+# each pair is stored once with id_1 < id_2, these cover lookups from either side. They are
+# built without blocking writes by migrate_similarity, not by create_tables
+SIMILARITY_INDEXES = {
+    'similarity_id_1_covering': "ON similarity (id_1, similarity_value, id_2)",
+    'similarity_id_2_covering': "ON similarity (id_2, similarity_value, id_1)"
+}
+
+# changes whenever a rating of user_ratings r is added, removed or updated
+RATING_FINGERPRINT = "count(r.movie_id) || ':' || " \
+                     "md5(coalesce(string_agg(r.movie_id || '=' || r.score, ',' ORDER BY r.movie_id), ''))"
+
 
 class DatabaseHandler:
 
-    def __init__(self):
+    def __init__(self, metrics=None):
+        """
+        :param metrics: PipelineMetrics counting the statements executed, or None
+        """
         self.cursor, self.conn = config.database_connection()
         self.dict_cursor = self.conn.cursor(cursor_factory=extras.RealDictCursor)
 
+        if metrics is not None:
+            self.cursor = CountingCursor(self.cursor, metrics)
+            self.dict_cursor = CountingCursor(self.dict_cursor, metrics)
+
+    def create_tables(self):
+        for statement in TABLES:
+            self.cursor.execute(statement)
+        self.conn.commit()
+
+    def create_notify_triggers(self):
+        """
+        create the triggers notifying changed ratings, unless they exist:
+        creating a trigger locks its table against writes of the backend
+        :return: None
+        """
+        for statement in NOTIFY_FUNCTIONS:
+            self.cursor.execute(statement)
+
+        self.cursor.execute("SELECT tgname FROM pg_trigger WHERE tgname = ANY(%s) AND NOT tgisinternal",
+                            (list(NOTIFY_TRIGGERS), ))
+        existing = set(row[0] for row in self.cursor.fetchall())
+        for name, definition in NOTIFY_TRIGGERS.items():
+            if name not in existing:
+                self.cursor.execute("CREATE TRIGGER " + name + " " + definition)
+        self.conn.commit()
+
+    def set_statement_timeout(self, seconds):
+        """
+        statements of this connection running longer are cancelled by the server
+        :param seconds: float
+        :return: None
+        """
+        self.cursor.execute("SET statement_timeout = %s", (int(seconds * 1000), ))
+        self.conn.commit()
+
     def get_users(self):
         self.dict_cursor.execute("SELECT id FROM users")
         return self.dict_cursor.fetchall()
@@ -21,6 +161,11 @@ class DatabaseHandler:
                             "WHERE user_id=%s AND u.movie_id = p.movie_id and p.score is not NULL", (user_id, ))
         return self.cursor.fetchall()
 
+    def get_all_user_history(self):
+        self.cursor.execute("SELECT DISTINCT u.user_id, u.movie_id, u.score FROM user_ratings u, public_ratings p "
+                            "WHERE u.movie_id = p.movie_id and p.score is not NULL")
+        return self.cursor.fetchall()
+
     def get_public_rating_dict(self, movie_id):
         self.dict_cursor.execute("SELECT * FROM public_ratings WHERE movie_id=%s AND score is not NULL", (movie_id, ))
         return self.dict_cursor.fetchall()
@@ -29,6 +174,49 @@ class DatabaseHandler:
         self.cursor.execute("SELECT * FROM public_ratings WHERE movie_id=%s AND score is not NULL", (movie_id, ))
         return self.cursor.fetchall()
 
+    def get_public_rating_vectors(self, movie_ids):
+        """
+        public ratings of many movies at once
+        :param movie_ids: list
+        :return: dictionary, movie id -> {
+            'scores': [IMDb, Douban, Trakt] score, None if missing,
+            'count': number of sources rated,
+            'updated_at': oldest update of the ratings
+        }
+        """
+        self.cursor.execute("SELECT movie_id, "
+                            "max(score) FILTER (WHERE source_id='1'), "
+                            "max(score) FILTER (WHERE source_id='2'), "
+                            "max(score) FILTER (WHERE source_id='3'), "
+                            "count(*), min(updated_at) "
+                            "FROM public_ratings WHERE movie_id = ANY(%s) AND score is not NULL "
+                            "GROUP BY movie_id", (movie_ids, ))
+        return {row[0]: {'scores': list(row[1:4]), 'count': row[4], 'updated_at': row[5]}
+                for row in self.cursor.fetchall()}
+
+    def get_scale_training_data(self, user_ids):
+        """
+        training data of the user scales: every rated movie with the
+        scores of all three sources, as one row per (user, movie)
+        :param user_ids: list
+        :return: numpy array of user ids of shape (n, ),
+                 numpy array of IMDb, Douban and Trakt scores of shape (n, 3),
+                 numpy array of user scores of shape (n, )
+        """
+        self.cursor.execute("SELECT u.user_id, "
+                            "max(p.score) FILTER (WHERE p.source_id='1'), "
+                            "max(p.score) FILTER (WHERE p.source_id='2'), "
+                            "max(p.score) FILTER (WHERE p.source_id='3'), "
+                            "u.score "
+                            "FROM user_ratings u JOIN public_ratings p "
+                            "ON p.movie_id = u.movie_id AND p.score is not NULL "
+                            "WHERE u.user_id = ANY(%s) "
+                            "GROUP BY u.user_id, u.movie_id, u.score "
+                            "HAVING count(DISTINCT p.source_id) FILTER (WHERE p.source_id IN ('1', '2', '3')) = 3 "
+                            "ORDER BY u.user_id", (user_ids, ))
+        rows = numpy.array(self.cursor.fetchall(), dtype=numpy.float64).reshape(-1, 5)
+        return rows[:, 0].astype(numpy.int64), rows[:, 1:4], rows[:, 4]
+
     def get_movie_id_by_year(self, year):
         today = datetime.datetime.now().strftime("%m-%d")
         upper = str(year) + "-" + today
@@ -77,23 +265,146 @@ class DatabaseHandler:
             source_id += 1
         self.conn.commit()
 
+    def get_rating_version(self, user_id):
+        """
+        version of the training set of the user scale, a primary key lookup
+        :param user_id: integer
+        :return: integer
+        """
+        self.cursor.execute("SELECT coalesce(max(version), 0) FROM rating_versions WHERE user_id=%s", (user_id, ))
+        return self.cursor.fetchone()[0]
+
+    def get_scale_statistics(self, user_id):
+        self.dict_cursor.execute("SELECT gram, moments, version FROM scale_statistics WHERE user_id=%s",
+                                 (user_id, ))
+        return self.dict_cursor.fetchone()
+
+    def save_scale_statistics(self, user_id, gram, moments, version):
+        self.cursor.execute(
+            "INSERT INTO scale_statistics (user_id, gram, moments, version) VALUES (%s, %s, %s, %s) "
+            "ON CONFLICT (user_id) DO UPDATE SET (gram, moments, version, updated_at) = "
+            "(EXCLUDED.gram, EXCLUDED.moments, EXCLUDED.version, now())",
+            (user_id, gram, moments, version)
+        )
+        self.conn.commit()
+
+    def get_dirty_users(self, seed_criterion, user_ids=None, published=False):
+        """
+        users whose recommendations may have changed since they were last
+        computed: new users, users whose ratings changed, and users with a
+        seed movie whose neighbour list, or the public ratings of one of
+        its neighbours, were updated since
+        :param seed_criterion: float, lowest score of a seed movie
+        :param user_ids: list, only these users are checked if given
+        :param published: boolean, neighbour lists are read from the NeighbourStore, a changed
+                          list then only counts once published to it
+        :return: list of (user id, rating fingerprint, checked at), to be
+                 stored by save_recommendation_state once computed
+        """
+        self.cursor.execute(
+            "WITH fingerprints AS ("
+            "SELECT u.id AS user_id, " + RATING_FINGERPRINT + " AS fingerprint "
+            "FROM users u LEFT JOIN user_ratings r ON r.user_id = u.id "
+            "WHERE %(user_ids)s::INTEGER[] IS NULL OR u.id = ANY(%(user_ids)s) GROUP BY u.id) "
+            "SELECT f.user_id, f.fingerprint, clock_timestamp()::timestamp "
+            "FROM fingerprints f LEFT JOIN recommendation_state s ON s.user_id = f.user_id "
+            "WHERE s.user_id IS NULL OR s.fingerprint <> f.fingerprint OR EXISTS ("
+            "SELECT 1 FROM user_ratings r, similarity_neighbours n "
+            "WHERE r.user_id = f.user_id AND r.score >= %(seed_criterion)s AND n.movie_id = r.movie_id AND ("
+            "n." + ('published_at' if published else 'updated_at') + " > s.computed_at OR EXISTS ("
+            "SELECT 1 FROM public_ratings p "
+            "WHERE p.movie_id = ANY(n.neighbour_ids) AND p.updated_at > s.computed_at)))",
+            {'seed_criterion': seed_criterion, 'user_ids': None if user_ids is None else list(user_ids)}
+        )
+        return self.cursor.fetchall()
+
+    def get_users_by_candidate_movies(self, movie_ids, seed_criterion):
+        """
+        users with a seed movie having one of the movies as a neighbour
+        :param movie_ids: list
+        :param seed_criterion: float, lowest score of a seed movie
+        :return: set of user ids
+        """
+        self.cursor.execute("SELECT DISTINCT r.user_id FROM similarity_neighbours n, user_ratings r "
+                            "WHERE n.neighbour_ids && %s::VARCHAR(255)[] AND r.movie_id = n.movie_id "
+                            "AND r.score >= %s", (movie_ids, seed_criterion))
+        return set(row[0] for row in self.cursor.fetchall())
+
+    def listen(self, channels):
+        """
+        subscribe this connection to notification channels, it then
+        stays in autocommit mode so that notifications are delivered
+        :param channels: list of channel names
+        :return: None
+        """
+        self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        for channel in channels:
+            self.cursor.execute("LISTEN " + channel)
+
+    def wait_for_notifications(self, timeout):
+        """
+        :param timeout: float, seconds to wait for a notification
+        :return: list of (channel, payload), json payloads decoded
+        """
+        if not self.conn.notifies and select.select([self.conn], [], [], timeout) == ([], [], []):
+            return []
+
+        self.conn.poll()
+        notifications = []
+        while self.conn.notifies:
+            notify = self.conn.notifies.pop(0)
+            payload = notify.payload
+            if payload.startswith('{'):
+                payload = json.loads(payload)
+            notifications.append((notify.channel, payload))
+        return notifications
+
+    def save_recommendation_state(self, states):
+        """
+        :param states: list of (user id, rating fingerprint, computed at)
+        :return: None
+        """
+        extras.execute_values(
+            self.cursor,
+            "INSERT INTO recommendation_state (user_id, fingerprint, computed_at) VALUES %s "
+            "ON CONFLICT (user_id) DO UPDATE SET (fingerprint, computed_at) = "
+            "(EXCLUDED.fingerprint, EXCLUDED.computed_at)",
+            states
+        )
+        self.conn.commit()
+
     def save_recommendations(self, recommendations, user_id):
-        for recommendation in recommendations:
-            movie_id, score = recommendation
-            self.cursor.execute(
-                "INSERT INTO recommendations (user_id, movie_id, score) "
-                "VALUES (%s, %s, %s) "
-                "ON CONFLICT (user_id, movie_id)"
-                "DO UPDATE SET score=%s "
-                "WHERE recommendations.user_id =%s AND recommendations.movie_id=%s",
-                (
-                    user_id, movie_id, score, score, user_id, movie_id
-                )
+        self.save_all_recommendations([(user_id, movie_id, score) for movie_id, score in recommendations], [user_id])
+
+    def save_all_recommendations(self, recommendations, user_ids):
+        """
+        replace the recommendations of the given users in one transaction,
+        their recommendations missing from the new ones are deleted
+        :param recommendations: list of (user id, movie id, score)
+        :param user_ids: list, users whose recommendations are replaced
+        :return: None
+        """
+        try:
+            extras.execute_values(
+                self.cursor,
+                "INSERT INTO recommendations (user_id, movie_id, score) VALUES %s "
+                "ON CONFLICT (user_id, movie_id) DO UPDATE SET score=EXCLUDED.score",
+                recommendations,
+                page_size=1000
             )
-        self.conn.commit()
+            self.cursor.execute("DELETE FROM recommendations r WHERE r.user_id = ANY(%s) AND (r.user_id, r.movie_id) "
+                                "NOT IN (SELECT * FROM unnest(%s::INTEGER[], %s::VARCHAR[]))",
+                                (list(user_ids),
+                                 [recommendation[0] for recommendation in recommendations],
+                                 [recommendation[1] for recommendation in recommendations]))
+            self.conn.commit()
+        except psycopg2.Error:
+            self.conn.rollback()
+            raise
 
     def get_similarity_of_movies(self, target_movie, source_movie):
-        self.cursor.execute("SELECT value FROM similarity WHERE id_1=%s AND id_2=%s", (target_movie, source_movie))
+        id_1, id_2 = sorted((target_movie, source_movie))
+        self.cursor.execute("SELECT similarity_value FROM similarity WHERE id_1=%s AND id_2=%s", (id_1, id_2))
         return self.cursor.fetchone()[0]
 
     def get_user_history_object(self):
@@ -130,28 +441,250 @@ class DatabaseHandler:
         return self.dict_cursor.fetchall()
 
     def save_similarity(self, movie_id_1, movie_id_2, similarity):
-        try:
-            self.cursor.execute(
-                "INSERT INTO similarity (id_1, id_2, similarity_value) VALUES (%s, %s, %s)",
-                (
-                    movie_id_1, movie_id_2, similarity
-                )
+        id_1, id_2 = sorted((movie_id_1, movie_id_2))
+        self.cursor.execute(
+            "INSERT INTO similarity (id_1, id_2, similarity_value) VALUES (%s, %s, %s) "
+            "ON CONFLICT (id_1, id_2) DO NOTHING",
+            (
+                id_1, id_2, similarity
             )
-            self.cursor.execute(
-                "INSERT INTO similarity (id_1, id_2, similarity_value) VALUES (%s, %s, %s)",
-                (
-                    movie_id_2, movie_id_1, similarity
-                )
-            )
-            self.conn.commit()
-        except psycopg2.IntegrityError:
-            self.conn.commit()
-            return
+        )
+        self.conn.commit()
+
+    def get_similarity_writer(self, batch_size):
+        return SimilarityWriter(self.conn, batch_size)
 
     def get_similarity_matrix_pair(self):
         self.cursor.execute("SELECT id_1, id_2 FROM similarity")
         return self.cursor.fetchall()
 
     def get_similar_movies_by_id(self, movie_id):
-        self.cursor.execute("SELECT id_2 FROM similarity WHERE similarity_value >= 0.4 AND id_1=%s", (movie_id, ))
+        self.cursor.execute("SELECT id_2 FROM similarity WHERE id_1=%s AND similarity_value >= 0.4 "
+                            "UNION ALL "
+                            "SELECT id_1 FROM similarity WHERE id_2=%s AND similarity_value >= 0.4",
+                            (movie_id, movie_id))
         return self.cursor.fetchall()
+
+    def migrate_similarity_pairs(self, batch_size):
+        """
+        move pairs stored as id_1 > id_2 to the canonical id_1 < id_2
+        layout, dropping them if the mirrored row exists. The table is
+        walked in primary key order, one committed batch at a time, so
+        readers and writers are only blocked on the rows of a batch.
+        :param batch_size: integer
+        :return: generator of (rows moved, last key of the batch)
+        """
+        last_key = ('', '')
+        while True:
+            self.cursor.execute(
+                "WITH batch AS ("
+                "  SELECT id_1, id_2 FROM similarity WHERE (id_1, id_2) > (%s, %s) ORDER BY id_1, id_2 LIMIT %s"
+                "), moved AS ("
+                "  DELETE FROM similarity s USING batch b "
+                "  WHERE s.id_1 = b.id_1 AND s.id_2 = b.id_2 AND s.id_1 > s.id_2 "
+                "  RETURNING s.id_1, s.id_2, s.similarity_value"
+                "), inserted AS ("
+                "  INSERT INTO similarity (id_1, id_2, similarity_value) "
+                "  SELECT id_2, id_1, similarity_value FROM moved "
+                "  ON CONFLICT (id_1, id_2) DO NOTHING"
+                ") "
+                "SELECT (SELECT count(*) FROM moved), b.id_1, b.id_2 FROM batch b "
+                "ORDER BY b.id_1 DESC, b.id_2 DESC LIMIT 1",
+                (last_key[0], last_key[1], batch_size)
+            )
+            row = self.cursor.fetchone()
+            self.conn.commit()
+            if row is None:  # no rows left after the last key
+                return
+            last_key = (row[1], row[2])
+            yield row[0], last_key
+
+    def create_similarity_indexes(self):
+        """
+        build the covering indexes of the similarity table concurrently,
+        so that writes go on during the build. An index left invalid by
+        a failed build is dropped and built again
+        :return: None
+        """
+        self.conn.commit()
+        self.conn.autocommit = True  # CREATE INDEX CONCURRENTLY cannot run in a transaction
+        try:
+            for name, definition in SIMILARITY_INDEXES.items():
+                self.cursor.execute("SELECT i.indisvalid FROM pg_index i, pg_class c "
+                                    "WHERE c.relname = %s AND i.indexrelid = c.oid", (name, ))
+                row = self.cursor.fetchone()
+                if row is not None and row[0]:
+                    continue
+                if row is not None:
+                    self.cursor.execute("DROP INDEX CONCURRENTLY IF EXISTS " + name)
+                self.cursor.execute("CREATE INDEX CONCURRENTLY " + name + " " + definition)
+        finally:
+            self.conn.autocommit = False
+
+    def validate_similarity_pairs(self):
+        """
+        enforce the canonical layout once all pairs are migrated
+        :return: None
+        """
+        self.cursor.execute("SELECT 1 FROM pg_constraint WHERE conname = 'similarity_canonical_pair'")
+        if self.cursor.fetchone() is None:
+            self.cursor.execute("ALTER TABLE similarity ADD CONSTRAINT similarity_canonical_pair "
+                                "CHECK (id_1 < id_2) NOT VALID")
+            self.conn.commit()
+        self.cursor.execute("ALTER TABLE similarity VALIDATE CONSTRAINT similarity_canonical_pair")
+        self.conn.commit()
+
+    def get_neighbours_by_ids(self, movie_ids, threshold=0.4):
+        """
+        distinct neighbours of many movies at once
+        :param movie_ids: list
+        :param threshold: float, lowest similarity of a neighbour
+        :return: set of movie ids
+        """
+        self.cursor.execute("SELECT DISTINCT n.neighbour_id FROM similarity_neighbours s, "
+                            "unnest(s.neighbour_ids, s.scores) AS n(neighbour_id, score) "
+                            "WHERE s.movie_id = ANY(%s) AND n.score >= %s", (movie_ids, threshold))
+        return set(row[0] for row in self.cursor.fetchall())
+
+    def get_ranked_neighbours_by_ids(self, movie_ids, threshold=0.4):
+        """
+        neighbours of many movies at once, with their highest and total
+        similarity across those movies, most similar first
+        :param movie_ids: list
+        :param threshold: float, lowest similarity of a neighbour
+        :return: list of (movie id, max similarity, sum of similarities)
+        """
+        self.cursor.execute("SELECT n.neighbour_id, max(n.score), sum(n.score) FROM similarity_neighbours s, "
+                            "unnest(s.neighbour_ids, s.scores) AS n(neighbour_id, score) "
+                            "WHERE s.movie_id = ANY(%s) AND n.score >= %s "
+                            "GROUP BY n.neighbour_id ORDER BY 2 DESC, 3 DESC", (movie_ids, threshold))
+        return self.cursor.fetchall()
+
+    def get_neighbour_lists(self, movie_ids):
+        self.cursor.execute("SELECT movie_id, neighbour_ids, scores FROM similarity_neighbours "
+                            "WHERE movie_id = ANY(%s)", (movie_ids, ))
+        return {row[0]: (row[1], row[2]) for row in self.cursor.fetchall()}
+
+    def get_all_neighbour_lists(self):
+        self.cursor.execute("SELECT movie_id, neighbour_ids, scores FROM similarity_neighbours")
+        return {row[0]: (row[1], row[2]) for row in self.cursor.fetchall()}
+
+    def get_timestamp(self):
+        self.cursor.execute("SELECT clock_timestamp()::timestamp")
+        timestamp = self.cursor.fetchone()[0]
+        self.conn.commit()
+        return timestamp
+
+    def mark_neighbour_lists_published(self, exported_at):
+        """
+        record that the neighbour lists exported at the given time are
+        now read by the recommender from the NeighbourStore, to be called
+        once the version is published: a recommender checking its users
+        before then still reads the previous version, so they are stamped
+        with the current time rather than the start of the transaction
+        :param exported_at: datetime, as returned by get_timestamp before the lists were read
+        :return: None
+        """
+        self.cursor.execute("UPDATE similarity_neighbours SET published_at = clock_timestamp() "
+                            "WHERE updated_at <= %s AND (published_at IS NULL OR published_at < updated_at)",
+                            (exported_at, ))
+        self.conn.commit()
+
+    def save_neighbour_lists(self, neighbour_lists):
+        """
+        the lists are stamped once committed, in a second transaction: a
+        recommender checking its users before the commit still reads the
+        previous lists, and has to see them updated after it
+        :param neighbour_lists: list of (movie id, neighbour ids, scores)
+        :return: None
+        """
+        extras.execute_values(
+            self.cursor,
+            "INSERT INTO similarity_neighbours (movie_id, neighbour_ids, scores) VALUES %s "
+            "ON CONFLICT (movie_id) DO UPDATE SET (neighbour_ids, scores) = (EXCLUDED.neighbour_ids, EXCLUDED.scores)",
+            neighbour_lists,
+            template="(%s, %s::VARCHAR(255)[], %s::REAL[])"
+        )
+        self.conn.commit()
+
+        self.cursor.execute("UPDATE similarity_neighbours SET updated_at = clock_timestamp() WHERE movie_id = ANY(%s)",
+                            ([row[0] for row in neighbour_lists], ))
+        self.conn.commit()
+
+    def get_scored_movie_ids(self, role):
+        self.cursor.execute("SELECT movie_id FROM similarity_watermarks WHERE role=%s", (role, ))
+        return set([row[0] for row in self.cursor.fetchall()])
+
+    def save_scored_movie_ids(self, movie_ids, role):
+        extras.execute_values(
+            self.cursor,
+            "INSERT INTO similarity_watermarks (movie_id, role) VALUES %s "
+            "ON CONFLICT (movie_id, role) DO UPDATE SET scored_at=now()",
+            [(movie_id, role) for movie_id in movie_ids]
+        )
+        self.conn.commit()
+
+
+class SimilarityWriter:
+    """
+        buffers scored pairs and writes them to the similarity table in
+        batches: each batch is streamed with COPY into a temporary staging
+        table, then merged with a single INSERT ... ON CONFLICT, within
+        one transaction per batch
+    """
+
+    def __init__(self, conn, batch_size):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.batch_size = batch_size
+        self.buffer = []
+
+        self.cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS similarity_staging ("
+            "id_1 VARCHAR(255), id_2 VARCHAR(255), similarity_value DOUBLE PRECISION"
+            ") ON COMMIT DELETE ROWS"
+        )
+        self.conn.commit()
+
+    def add(self, movie_id_1, movie_id_2, similarity):
+        """
+        queue a pair, stored once with the smaller id first,
+        flushing once the batch is full
+        :param movie_id_1: string
+        :param movie_id_2: string
+        :param similarity: float
+        :return: None
+        """
+        if movie_id_1 < movie_id_2:
+            self.buffer.append((movie_id_1, movie_id_2, similarity))
+        else:
+            self.buffer.append((movie_id_2, movie_id_1, similarity))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def add_many(self, movie_id, neighbour_ids, similarities):
+        for neighbour_id, similarity in zip(neighbour_ids, similarities.tolist()):
+            self.add(movie_id, neighbour_id, similarity)
+
+    def flush(self):
+        if not self.buffer:
+            return
+
+        rows = io.StringIO()
+        for movie_id_1, movie_id_2, similarity in self.buffer:
+            rows.write(movie_id_1 + "\t" + movie_id_2 + "\t" + repr(similarity) + "\n")
+        rows.seek(0)
+
+        try:
+            self.cursor.copy_expert("COPY similarity_staging (id_1, id_2, similarity_value) FROM STDIN", rows)
+            self.cursor.execute(
+                "INSERT INTO similarity (id_1, id_2, similarity_value) "
+                "SELECT DISTINCT ON (id_1, id_2) id_1, id_2, similarity_value FROM similarity_staging "
+                "ON CONFLICT (id_1, id_2) DO UPDATE SET similarity_value=EXCLUDED.similarity_value"
+            )
+            self.conn.commit()
+        except psycopg2.Error:
+            self.conn.rollback()
+            raise
+
+        self.buffer = []
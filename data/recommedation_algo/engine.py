@@ -0,0 +1,187 @@
+"""
+    vectorized similarity calculation based on sparse incidence matrices
+"""
+from recommedation_algo.features import FeatureExtractor
+from scipy import sparse
+
+import numpy
+
+
+class EncodedMovies:
+    """
+        a set of movies encoded against the vocabularies of
+        a SimilarityEngine, one row per movie
+    """
+
+    def __init__(self, movie_ids, token_ids, sizes, runtimes):
+        self.movie_ids = movie_ids
+        self.token_ids = token_ids  # feature -> list of sorted unique token id lists
+        self.sizes = sizes  # feature -> number of tokens before de-duplication
+        self.runtimes = runtimes
+        self.matrices = {}  # feature -> cached incidence matrix
+
+    def __len__(self):
+        return len(self.movie_ids)
+
+
+class SimilarityEngine:
+    """
+        this class computes the same similarity values as
+        MovieSimilarity._calculate_similarity, for many pairs at once
+
+        each comma separated feature is turned into a vocabulary of token
+        ids, and every movie is encoded as a row of a binary CSR incidence
+        matrix. The number of shared tokens of all pairs is then a single
+        sparse matrix product, from which the dice coefficient is derived.
+    """
+
+    FEATURES = FeatureExtractor.FEATURES
+
+    def __init__(self, weights, runtime_weight, extractor=None):
+        """
+        :param weights: dictionary, feature name -> weight
+        :param runtime_weight: float
+        :param extractor: FeatureExtractor, owner of the token vocabularies
+        """
+        self.weights = weights
+        self.runtime_weight = runtime_weight
+        self.extractor = extractor or FeatureExtractor()
+
+    @property
+    def vocabularies(self):
+        return self.extractor.vocabularies
+
+    def encode(self, features):
+        """
+        encode movie features, or movie rows which are then
+        parsed by the extractor
+        :param features: list of MovieFeatures or dictionaries
+        :return: EncodedMovies
+        """
+        if features and isinstance(features[0], dict):
+            features = self.extractor.extract(features)
+
+        token_ids = {}
+        sizes = {}
+        for feature in self.FEATURES:
+            token_ids[feature] = [sorted(getattr(record, feature)) for record in features]
+            sizes[feature] = numpy.array([getattr(record, feature + '_size') for record in features],
+                                         dtype=numpy.float64)
+        runtimes = numpy.array([record.runtime for record in features], dtype=numpy.float64)
+
+        return EncodedMovies([record.movie_id for record in features], token_ids, sizes, runtimes)
+
+    def score(self, left, right):
+        """
+        similarity of every movie in left against every movie in right
+        :param left: EncodedMovies
+        :param right: EncodedMovies
+        :return: numpy array of shape (len(left), len(right))
+        """
+        total = self._runtime_similarity(left.runtimes, right.runtimes)
+
+        for feature in self.FEATURES:
+            left_matrix = self.incidence_matrix(left, feature)
+            right_matrix = self.incidence_matrix(right, feature)
+            shared = (left_matrix @ right_matrix.T).toarray()
+            average_count = (left.sizes[feature][:, None] + right.sizes[feature][None, :]) / 2
+            total += self.weights[feature] * (shared / average_count)
+
+        return total
+
+    def score_pairs(self, left, right, left_rows, right_rows):
+        """
+        similarity of selected pairs only, the i-th pair being the
+        movie left_rows[i] of left against the movie right_rows[i] of right
+        :param left: EncodedMovies
+        :param right: EncodedMovies
+        :param left_rows: numpy array of integers
+        :param right_rows: numpy array of integers
+        :return: numpy array of shape (len(left_rows), )
+        """
+        total = self._runtime_similarity(left.runtimes[left_rows], right.runtimes[right_rows], paired=True)
+
+        for feature in self.FEATURES:
+            left_matrix = self.incidence_matrix(left, feature)[left_rows]
+            right_matrix = self.incidence_matrix(right, feature)[right_rows]
+            shared = numpy.asarray(left_matrix.multiply(right_matrix).sum(axis=1)).ravel()
+            average_count = (left.sizes[feature][left_rows] + right.sizes[feature][right_rows]) / 2
+            total += self.weights[feature] * (shared / average_count)
+
+        return total
+
+    def score_blocks(self, left, right, block_size):
+        """
+        score left against right in blocks of rows, so that only
+        block_size * len(right) values are held in memory at once
+        :param left: EncodedMovies
+        :param right: EncodedMovies
+        :param block_size: integer
+        :return: generator of (row offset, numpy array)
+        """
+        for start in range(0, len(left), block_size):
+            yield start, self.score(self.subset(left, start, start + block_size), right)
+
+    def incidence_matrix(self, encoded, feature):
+        """
+        binary CSR matrix of movies against the tokens of one feature
+        :param encoded: EncodedMovies
+        :param feature: string
+        :return: scipy.sparse.csr_matrix
+        """
+        width = len(self.vocabularies[feature])
+        matrix = encoded.matrices.get(feature)
+
+        if matrix is None:
+            rows = encoded.token_ids[feature]
+            indptr = numpy.zeros(len(rows) + 1, dtype=numpy.int64)
+            numpy.cumsum([len(row) for row in rows], out=indptr[1:])
+            indices = numpy.fromiter((token for row in rows for token in row), dtype=numpy.int64, count=indptr[-1])
+            data = numpy.ones(len(indices), dtype=numpy.float64)
+            matrix = sparse.csr_matrix((data, indices, indptr), shape=(len(rows), width))
+            encoded.matrices[feature] = matrix
+        elif matrix.shape[1] != width:  # vocabulary grew since the matrix was built
+            matrix = sparse.csr_matrix((matrix.data, matrix.indices, matrix.indptr), shape=(matrix.shape[0], width))
+            encoded.matrices[feature] = matrix
+
+        return matrix
+
+    @staticmethod
+    def subset(encoded, start, end):
+        """
+        slice of an encoded movie set
+        :param encoded: EncodedMovies
+        :param start: integer
+        :param end: integer
+        :return: EncodedMovies
+        """
+        return EncodedMovies(
+            encoded.movie_ids[start:end],
+            {feature: value[start:end] for feature, value in encoded.token_ids.items()},
+            {feature: value[start:end] for feature, value in encoded.sizes.items()},
+            encoded.runtimes[start:end]
+        )
+
+    @staticmethod
+    def take(encoded, rows):
+        """
+        rows of an encoded movie set, in the given order
+        :param encoded: EncodedMovies
+        :param rows: list or numpy array of integers
+        :return: EncodedMovies
+        """
+        taken = EncodedMovies(
+            [encoded.movie_ids[row] for row in rows],
+            {feature: [value[row] for row in rows] for feature, value in encoded.token_ids.items()},
+            {feature: value[rows] for feature, value in encoded.sizes.items()},
+            encoded.runtimes[rows]
+        )
+        taken.matrices = {feature: matrix[rows] for feature, matrix in encoded.matrices.items()}
+        return taken
+
+    def _runtime_similarity(self, left_runtimes, right_runtimes, paired=False):
+        if not paired:
+            left_runtimes = left_runtimes[:, None]
+            right_runtimes = right_runtimes[None, :]
+        difference = numpy.abs(left_runtimes - right_runtimes)
+        return self.runtime_weight * (1 - difference / right_runtimes)
@@ -0,0 +1,77 @@
+"""
+    per-movie features used by the similarity calculations
+"""
+
+
+class MovieFeatures:
+    """
+        compact, parsed form of a movie row: the comma separated genre,
+        actors and director strings become frozensets of interned token
+        ids, and the runtime an integer
+    """
+
+    __slots__ = ('movie_id', 'genre', 'actors', 'director',
+                 'genre_size', 'actors_size', 'director_size', 'runtime')
+
+    def __init__(self, movie_id, genre, actors, director, sizes, runtime):
+        self.movie_id = movie_id
+        self.genre = genre
+        self.actors = actors
+        self.director = director
+        self.genre_size, self.actors_size, self.director_size = sizes  # token counts before de-duplication
+        self.runtime = runtime
+
+
+class FeatureExtractor:
+    """
+        turns movie rows, as returned by the database handler, into
+        MovieFeatures, interning every token into a per-feature vocabulary
+    """
+
+    FEATURES = ('genre', 'actors', 'director')
+
+    def __init__(self):
+        self.vocabularies = {feature: {} for feature in self.FEATURES}
+        self.records = {}
+
+    def extract(self, movie_objects):
+        """
+        parse movie rows, each distinct row is parsed only once
+        :param movie_objects: list of dictionaries
+        :return: list of MovieFeatures
+        """
+        features = []
+        for movie_object in movie_objects:
+            key = (movie_object['movie_id'], movie_object['genre'], movie_object['actors'],
+                   movie_object['director'], movie_object['runtime'])
+            record = self.records.get(key)
+            if record is None:
+                record = self._extract_movie(movie_object)
+                self.records[key] = record
+            features.append(record)
+        return features
+
+    def clear(self):
+        """
+        forget the parsed rows, but keep the vocabularies
+        so that token ids stay stable
+        :return: None
+        """
+        self.records = {}
+
+    def _extract_movie(self, movie_object):
+        token_sets = []
+        sizes = []
+        for feature in self.FEATURES:
+            tokens = self._tokenize_string(movie_object[feature])
+            vocabulary = self.vocabularies[feature]
+            token_sets.append(frozenset(vocabulary.setdefault(token, len(vocabulary)) for token in tokens))
+            sizes.append(len(tokens))
+
+        genre, actors, director = token_sets
+        return MovieFeatures(movie_object['movie_id'], genre, actors, director, sizes, int(movie_object['runtime']))
+
+    @staticmethod
+    def _tokenize_string(value):
+        tokens = value.split(",")
+        return [token.strip() for token in tokens]
@@ -0,0 +1,90 @@
+"""
+    inverted index used to prune the pairs given to the similarity engine
+"""
+import numpy
+
+
+class InvertedIndex:
+    """
+        incidence matrices of the genre, actor and director tokens of a
+        movie pool, from which the pairs sharing tokens are found
+
+        a pair of movies sharing no token in a feature gets nothing from
+        that feature's weight, so the similarity of a pair is bounded by
+        the runtime weight plus the weights of the features it shares.
+        Leaving out the most common features while their weights and the
+        runtime weight stay below the minimum score, a pair must share a
+        token of one of the remaining, required, features to reach it.
+        Candidates are the pairs sharing such a token, found for a block
+        of movies at once with sparse matrix products.
+
+        scoring selected pairs costs far more per pair than scoring whole
+        blocks, so pruning is only worth it when at most DENSE_FRACTION of
+        the pairs are expected to share a required token.
+    """
+
+    DENSE_FRACTION = 0.05  # share of candidate pairs above which whole blocks are scored
+
+    def __init__(self, engine, movies):
+        """
+        :param engine: SimilarityEngine
+        :param movies: EncodedMovies, usually the movie pool
+        """
+        self.engine = engine
+        self.movies = movies
+        self.size = len(movies)
+
+        # share of the pairs of the pool expected to share a token of each feature
+        self.densities = {}
+        for feature in engine.FEATURES:
+            frequencies = numpy.asarray(engine.incidence_matrix(movies, feature).sum(axis=0)).ravel()
+            self.densities[feature] = min(1.0, float((frequencies ** 2).sum()) / max(1, self.size) ** 2)
+
+    def required_features(self, min_score):
+        """
+        features of which a pair must share a token to reach min_score
+        :param min_score: float
+        :return: list of features, None if the runtime alone may reach min_score
+        """
+        if min_score <= self.engine.runtime_weight:
+            return None
+
+        bound = self.engine.runtime_weight
+        required = []
+        for feature in sorted(self.engine.FEATURES, key=self.densities.get, reverse=True):  # most common first
+            if bound + self.engine.weights[feature] < min_score - 1e-9:
+                bound += self.engine.weights[feature]
+            else:
+                required.append(feature)
+        return required
+
+    def prunes(self, min_score):
+        """
+        :param min_score: float
+        :return: boolean, whether scoring the candidate pairs only is cheaper than scoring all pairs
+        """
+        required = self.required_features(min_score)
+        return required is not None and sum(self.densities[feature] for feature in required) <= self.DENSE_FRACTION
+
+    def candidate_pairs(self, movies, start, end, min_score):
+        """
+        pairs of the movies start to end against the indexed pool
+        that may be at least min_score similar
+        :param movies: EncodedMovies
+        :param start: integer
+        :param end: integer
+        :param min_score: float, above the runtime weight
+        :return: numpy array of rows of movies, numpy array of rows of the pool, sorted by the former
+        """
+        shared = None
+        for feature in self.required_features(min_score):
+            product = self.engine.incidence_matrix(movies, feature)[start:end] @ \
+                self.engine.incidence_matrix(self.movies, feature).T
+            shared = product if shared is None else shared + product
+
+        if shared is None:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+        shared = shared.tocsr()
+        shared.sum_duplicates()
+        rows = numpy.repeat(numpy.arange(start, end), numpy.diff(shared.indptr))
+        return rows, shared.indices.astype(numpy.int64)
@@ -0,0 +1,154 @@
+"""
+    event driven recommendations, from notifications of changed ratings
+"""
+from recommedation_algo.database import DatabaseHandler
+from recommedation_algo.scale import UserScale
+
+import logging
+import psycopg2
+import time
+
+
+class RecommendationListener:
+    """
+        listens to the notifications sent by the triggers of user_ratings
+        and public_ratings, and recomputes the recommendations of the
+        affected users only
+
+        notifications are collected until none arrived for DEBOUNCE
+        seconds, or for at most MAX_DELAY seconds, and then handled as one
+        batch. Every SWEEP_INTERVAL seconds all users are checked as well,
+        in case a notification was missed, e.g. while the service was down
+
+        after a failure the loop backs off, doubling the wait from BACKOFF
+        up to MAX_BACKOFF seconds while failures follow each other, and
+        reopens the connections that were lost
+    """
+
+    CHANNELS = ['user_ratings', 'public_ratings']
+
+    DEBOUNCE = 2  # seconds without notification before a batch is recomputed
+
+    MAX_DELAY = 10  # seconds a notification waits at most before its batch is recomputed
+
+    SWEEP_INTERVAL = 3600  # seconds between two full sweeps
+
+    BACKOFF = 1  # seconds waited after a first failure
+
+    MAX_BACKOFF = 60  # seconds waited at most after consecutive failures
+
+    def __init__(self, recommender, db=None, db_factory=None):
+        """
+        :param recommender: Recommender
+        :param db: DatabaseHandler, its connection is dedicated to listening
+        :param db_factory: callable taking PipelineMetrics or None and returning a DatabaseHandler,
+                           used to reopen lost connections
+        """
+        self.recommender = recommender
+        self.db_factory = db_factory or DatabaseHandler
+        self.db = db or self.db_factory()
+        self.listening = False
+        self.last_sweep = None
+        self.failures = 0
+
+    def run(self):
+        while True:
+            try:
+                if not self.listening:
+                    self.listen()
+                self.sweep_if_due()
+                notifications = self.db.wait_for_notifications(self.seconds_until_sweep())
+                if notifications:
+                    self.handle(notifications + self.collect())
+                self.failures = 0
+            except Exception:  # keep listening, the users are picked up by the next sweep at the latest
+                logging.exception("failed to recompute recommendations")
+                self.last_sweep = self.last_sweep or time.time()
+                self.failures += 1
+                time.sleep(min(self.MAX_BACKOFF, self.BACKOFF * 2 ** (self.failures - 1)))
+                self.recover()
+
+    def listen(self):
+        """
+        subscribe to the channels, on a new connection if the previous one was lost
+        :return: None
+        """
+        if self.db.conn.closed:
+            self.db = self.db_factory()
+        self.db.create_notify_triggers()
+        self.db.listen(self.CHANNELS)
+        self.listening = True
+        logging.info("listening to " + ", ".join(self.CHANNELS) + " ...")
+
+    def recover(self):
+        """
+        after a failure, roll the recommender back, reconnecting it if its
+        connection was lost. If the listening connection was lost, the next
+        iteration subscribes again on a new one, and sweeps: notifications
+        sent in the meantime are never delivered
+        :return: None
+        """
+        try:
+            self.recommender.db.conn.rollback()
+        except psycopg2.Error:
+            logging.warning("recommender connection lost, reconnecting")
+            try:
+                self.recommender.db = self.db_factory(self.recommender.metrics)
+            except psycopg2.Error:  # tried again after the next failure
+                logging.exception("failed to reconnect the recommender")
+
+        if self.db.conn.closed:
+            logging.warning("listening connection lost")
+            self.listening = False
+            self.last_sweep = None
+
+    def sweep_if_due(self):
+        if self.last_sweep is None or time.time() - self.last_sweep >= self.SWEEP_INTERVAL:
+            logging.info("full sweep of user recommendations")
+            self.recommender.update_user_recommendations()
+            self.last_sweep = time.time()
+
+    def seconds_until_sweep(self):
+        return max(0, self.last_sweep + self.SWEEP_INTERVAL - time.time())
+
+    def collect(self):
+        """
+        debounce: wait for the notifications following the first one
+        :return: list of (channel, payload)
+        """
+        notifications = []
+        started = time.time()
+
+        while time.time() - started < self.MAX_DELAY:
+            received = self.db.wait_for_notifications(min(self.DEBOUNCE, self.MAX_DELAY - (time.time() - started)))
+            if not received:
+                break
+            notifications.extend(received)
+        return notifications
+
+    def handle(self, notifications):
+        """
+        update the scales of users whose ratings changed, from the
+        notified scores, then recompute them and the users having a
+        candidate movie with updated public ratings
+        :param notifications: list of (channel, payload)
+        :return: None
+        """
+        user_ids = set()
+        movie_ids = set()
+
+        for channel, payload in notifications:
+            if channel == 'user_ratings':
+                user_ids.add(payload['user_id'])
+                UserScale(payload['user_id'], self.recommender.db,
+                          (payload['movie_id'], payload['score'], payload['old_score'], payload['version']))
+            else:
+                movie_ids.add(payload)
+
+        if movie_ids:
+            user_ids |= self.recommender.db.get_users_by_candidate_movies(list(movie_ids),
+                                                                          self.recommender.USER_RATINGS_CRITERION)
+
+        logging.info(str(len(notifications)) + " notifications, recomputing " + str(len(user_ids)) + " users")
+        if user_ids:
+            self.recommender.update_user_recommendations(list(user_ids))
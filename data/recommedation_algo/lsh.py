@@ -0,0 +1,96 @@
+"""
+    MinHash signatures and locality sensitive hashing of movie token sets
+"""
+import numpy
+
+
+class MinHashLSH:
+    """
+        approximates the pairs of similar movies of a large catalog
+
+        each movie is reduced to the set of its genre, actor and director
+        tokens, and summarised by a MinHash signature: the minimum of
+        several random hash functions over the set. Two signatures agree
+        on a position with a probability equal to the jaccard similarity of
+        the sets. Signatures are cut into bands, and movies with an
+        identical band fall into the same bucket and become candidates.
+    """
+
+    PRIME = 2147483647  # mersenne prime 2^31 - 1, keeps a * x within 64 bits
+
+    def __init__(self, permutations=128, bands=64, max_bucket_size=1000, seed=0):
+        """
+        :param permutations: integer, length of the signatures
+        :param bands: integer, must divide permutations
+        :param max_bucket_size: integer, larger buckets are ignored as uninformative
+        :param seed: integer
+        """
+        if permutations % bands != 0:
+            raise ValueError("bands must divide permutations")
+
+        self.permutations = permutations
+        self.bands = bands
+        self.rows = permutations // bands
+        self.max_bucket_size = max_bucket_size
+
+        generator = numpy.random.RandomState(seed)
+        self.a = generator.randint(1, self.PRIME, size=permutations).astype(numpy.int64)
+        self.b = generator.randint(0, self.PRIME, size=permutations).astype(numpy.int64)
+
+    def signatures(self, engine, movies, chunk_size=10000):
+        """
+        :param engine: SimilarityEngine, owner of the token vocabularies
+        :param movies: EncodedMovies
+        :param chunk_size: integer, movies hashed at once
+        :return: numpy array of shape (len(movies), permutations)
+        """
+        offsets = {}
+        offset = 0
+        for feature in engine.FEATURES:  # one id space across all features
+            offsets[feature] = offset
+            offset += len(engine.vocabularies[feature])
+
+        signatures = numpy.empty((len(movies), self.permutations), dtype=numpy.int64)
+
+        for start in range(0, len(movies), chunk_size):
+            end = min(start + chunk_size, len(movies))
+            tokens = []
+            counts = []
+            for row in range(start, end):
+                movie_tokens = [offsets[feature] + token
+                                for feature in engine.FEATURES for token in movies.token_ids[feature][row]]
+                tokens.extend(movie_tokens)
+                counts.append(len(movie_tokens))
+
+            hashes = (numpy.array(tokens, dtype=numpy.int64)[:, None] * self.a + self.b) % self.PRIME
+            boundaries = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+            signatures[start:end] = numpy.minimum.reduceat(hashes, boundaries, axis=0)
+
+        return signatures
+
+    def candidate_pairs(self, signatures):
+        """
+        pairs of movies sharing at least one band
+        :param signatures: numpy array of shape (n, permutations)
+        :return: two numpy arrays of rows, first < second
+        """
+        size = len(signatures)
+        keys = []
+
+        for band in range(self.bands):
+            columns = signatures[:, band * self.rows:(band + 1) * self.rows]
+            _, buckets, bucket_sizes = numpy.unique(columns, axis=0, return_inverse=True, return_counts=True)
+            buckets = buckets.ravel()
+
+            order = numpy.argsort(buckets, kind='stable')
+            boundaries = numpy.cumsum(bucket_sizes)
+            for bucket in numpy.flatnonzero((bucket_sizes > 1) & (bucket_sizes <= self.max_bucket_size)):
+                members = order[boundaries[bucket] - bucket_sizes[bucket]:boundaries[bucket]]
+                first, second = numpy.triu_indices(len(members), k=1)
+                keys.append(members[first].astype(numpy.int64) * size + members[second])
+
+        if not keys:
+            return numpy.array([], dtype=numpy.int64), numpy.array([], dtype=numpy.int64)
+
+        keys = numpy.unique(numpy.concatenate(keys))
+        return keys // size, keys % size
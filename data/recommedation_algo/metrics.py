@@ -0,0 +1,144 @@
+"""
+    timings and counters of the recommendation pipeline
+"""
+from contextlib import contextmanager
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'metrics.json')
+
+
+class PipelineMetrics:
+    """
+        records the wall time of each stage of the pipeline and named
+        counters, such as SQL statements and rating refreshes, both per
+        user and in aggregate
+
+        values recorded inside a user() block by the same thread are
+        attributed to that user, the others, e.g. those of background
+        threads, only count towards the totals
+    """
+
+    STAGES = ('seeds', 'neighbours', 'scoring')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = None
+        self.users = None  # user id -> {name: value}
+        self.totals = None  # name -> value
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.users = {}
+            self.totals = {}
+
+    @contextmanager
+    def user(self, user_id):
+        self.local.user_id = user_id
+        try:
+            yield
+        finally:
+            self.local.user_id = None
+
+    @contextmanager
+    def stage(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.increment(name + '_seconds', time.time() - started)
+
+    def increment(self, name, value=1):
+        user_id = getattr(self.local, 'user_id', None)
+        with self.lock:
+            self.totals[name] = self.totals.get(name, 0) + value
+            if user_id is not None:
+                user = self.users.setdefault(user_id, {})
+                user[name] = user.get(name, 0) + value
+
+    def merge(self, users, totals):
+        """
+        add the values recorded by another instance, e.g. in a worker process
+        :param users: dictionary, user id -> {name: value}
+        :param totals: dictionary, name -> value
+        :return: None
+        """
+        with self.lock:
+            for name, value in totals.items():
+                self.totals[name] = self.totals.get(name, 0) + value
+            for user_id, values in users.items():
+                user = self.users.setdefault(user_id, {})
+                for name, value in values.items():
+                    user[name] = user.get(name, 0) + value
+
+    def summary(self):
+        """
+        :return: dictionary, totals and per user means since the last reset
+        """
+        with self.lock:
+            user_count = len(self.users)
+            return {
+                'started_at': self.started,
+                'elapsed_seconds': time.time() - self.started,
+                'users': user_count,
+                'totals': dict(self.totals),
+                'per_user_mean': {name: value / user_count for name, value in self.totals.items()} if user_count else {}
+            }
+
+    def log_summary(self):
+        summary = self.summary()
+        logging.info("pipeline metrics: " + str(summary['users']) + " users in " +
+                     str(round(summary['elapsed_seconds'], 2)) + "s")
+        for name, value in sorted(summary['totals'].items()):
+            mean = summary['per_user_mean'].get(name)
+            logging.info("  " + name + ": " + str(round(value, 4)) +
+                         ("" if mean is None else " (" + str(round(mean, 4)) + " per user)"))
+
+    def write(self, path=DEFAULT_PATH):
+        """
+        write the summary and the per user values as json, replacing
+        the previous file atomically
+        :param path: string
+        :return: None
+        """
+        with self.lock:
+            users = {str(user_id): dict(values) for user_id, values in self.users.items()}
+        content = {'summary': self.summary(), 'users': users}
+
+        descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+        with os.fdopen(descriptor, 'w') as metrics_file:
+            json.dump(content, metrics_file)
+        os.replace(temporary_path, path)
+
+
+class CountingCursor:
+    """
+        cursor proxy counting the statements executed through it
+    """
+
+    def __init__(self, cursor, metrics, name='statements'):
+        self.cursor = cursor
+        self.metrics = metrics
+        self.name = name
+
+    def execute(self, query, variables=None):
+        self.metrics.increment(self.name)
+        return self.cursor.execute(query, variables)
+
+    def executemany(self, query, variables_list):
+        self.metrics.increment(self.name)
+        return self.cursor.executemany(query, variables_list)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
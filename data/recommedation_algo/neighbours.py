@@ -0,0 +1,86 @@
+"""
+    bounded top-k neighbour lists of movies
+"""
+import heapq
+import numpy
+
+
+class TopKNeighbours:
+    """
+        keeps, for each history movie, a bounded min-heap of its k most
+        similar movies, and stores them as one row per movie in the
+        similarity_neighbours table
+
+        it accepts scored pairs like SimilarityWriter does, so the
+        similarity job can write to either of them
+    """
+
+    def __init__(self, db, k, merge=False):
+        """
+        :param db: DatabaseHandler
+        :param k: integer, neighbours kept per movie
+        :param merge: boolean, merge with the stored lists instead of replacing them
+        """
+        self.db = db
+        self.k = k
+        self.merge = merge
+        self.heaps = {}
+
+    def add(self, movie_id_1, movie_id_2, similarity):
+        heap = self.heaps.setdefault(movie_id_1, [])
+        if len(heap) < self.k:
+            heapq.heappush(heap, (similarity, movie_id_2))
+        elif similarity > heap[0][0]:
+            heapq.heapreplace(heap, (similarity, movie_id_2))
+
+    def add_many(self, movie_id, neighbour_ids, similarities):
+        """
+        add the scores of one movie against many others, only
+        the k best of them, and those tied with the k-th, are pushed to
+        the heap, which breaks ties the same way whatever the order the
+        pairs are scored in
+        :param movie_id: string
+        :param neighbour_ids: list of strings
+        :param similarities: numpy array
+        :return: None
+        """
+        if len(similarities) > self.k:
+            best = numpy.flatnonzero(similarities >= numpy.partition(similarities, -self.k)[-self.k])
+        else:
+            best = range(len(similarities))
+        for position in best:
+            self.add(movie_id, str(neighbour_ids[position]), float(similarities[position]))
+
+    def get_neighbours(self, movie_id):
+        """
+        :param movie_id: string
+        :return: list of (neighbour id, similarity), most similar first
+        """
+        return [(neighbour_id, similarity)
+                for similarity, neighbour_id in sorted(self.heaps.get(movie_id, []), reverse=True)]
+
+    def flush(self):
+        """
+        store the collected lists, merging them with the stored
+        ones if required
+        :return: None
+        """
+        if not self.heaps:
+            return
+
+        if self.merge:
+            stored = self.db.get_neighbour_lists(list(self.heaps.keys()))
+            for movie_id, (neighbour_ids, similarities) in stored.items():
+                collected = set(neighbour_id for _, neighbour_id in self.heaps[movie_id])
+                for neighbour_id, similarity in zip(neighbour_ids, similarities):
+                    if neighbour_id not in collected:  # newly scored pairs take precedence
+                        self.add(movie_id, neighbour_id, similarity)
+
+        rows = []
+        for movie_id in self.heaps:
+            neighbours = self.get_neighbours(movie_id)
+            rows.append((movie_id, [neighbour_id for neighbour_id, _ in neighbours],
+                         [similarity for _, similarity in neighbours]))
+
+        self.db.save_neighbour_lists(rows)
+        self.heaps = {}
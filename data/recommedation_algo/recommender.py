@@ -5,8 +5,19 @@ from recommedation_algo.database import DatabaseHandler
 from public_data.controller import ETLController
 from datetime import datetime, timedelta
 from recommedation_algo.scale import UserScale
+from recommedation_algo.refresh import RefreshQueue, RefreshRequests
+from recommedation_algo.metrics import PipelineMetrics
+from recommedation_algo.store import NeighbourStore
 
+import heapq
 import logging
+import multiprocessing
+import numpy
+import signal
+import time
+
+# recommender of a worker process, set by _initialise_worker
+_WORKER_CONTEXT = {}
 
 
 class Recommender:
@@ -15,32 +26,237 @@ class Recommender:
 
     SIMILARITY_CRITERION = 0.5  # similarity index above 0.5 means roughly more than one similar feature
 
+    NEIGHBOUR_CRITERION = 0.4  # lowest similarity of a neighbour to be considered as a candidate
+
     RECOMMEND_CRITERION = 6.5  # user ratings are limited, a relatively lower criterion is good to generate more recom
 
     SIMILAR_MOVIE_POOL_SIZE = 50  # iteration wise, 50 similar movies will be selected and subjected to recommendation
 
     ANOMALY_CRITERION = 20  # prevent anomaly in regression results
 
-    def __init__(self):
-        self.controller = ETLController()
-        self.db = DatabaseHandler()
+    RECOMMEND_LIMIT = 100  # only the best recommendations of each user are kept
+
+    USER_CHUNK_SIZE = 50  # users handed to a worker process at once in parallel mode
+
+    USER_TIMEOUT = 60  # seconds a worker process spends on one user before giving up on them
+
+    CHUNK_TIMEOUT = 600  # seconds without any chunk completing before the worker processes are terminated
+
+    LATENCY_BUDGET = 0.05  # seconds, on demand recommendations slower than this are logged
 
-    def update_user_recommendations(self):
+    RATING_CACHE_TTL = 600  # seconds public ratings are served from memory by recommend_for_user
+
+    def __init__(self, store=None, refresh_queue=None, limit=RECOMMEND_LIMIT, workers=1, metrics_path=None,
+                 db=None, db_factory=None):
+        """
+        :param store: NeighbourStore or None, neighbour lists are then read from the database
+        :param refresh_queue: RefreshQueue re-extracting outdated ratings in the background
+        :param limit: integer, number of recommendations kept per user
+        :param workers: integer, number of worker processes, users are processed in this process if 1
+        :param metrics_path: string, file the metrics of each run are written to, or None
+        :param db: DatabaseHandler, a new connection is opened if None
+        :param db_factory: picklable callable taking PipelineMetrics and returning a DatabaseHandler,
+                           opens the connections of the worker processes
+        """
+        self.metrics = PipelineMetrics()
+        self.metrics_path = metrics_path
+        self.db_factory = db_factory or DatabaseHandler
+        self.db = db or self.db_factory(self.metrics)
+        self.db.create_tables()
+        self.store = store
+        self.refresh_queue = refresh_queue or RefreshQueue(ETLController, metrics=self.metrics)
+        self.limit = limit
+        self.workers = workers
+
+        # caches of recommend_for_user
+        self.rating_cache = {}  # movie id -> (loaded at, ratings as returned by get_public_rating_vectors)
+        self.seed_cache = {}  # user id -> (rating version, favourite movies)
+        self.scale_cache = {}  # user id -> UserScale
+        self.popular_movies = None  # (loaded at, list of [movie id, score])
+
+    def update_user_recommendations(self, user_ids=None):
         """
-        for each user, generate recommendations and store them
+        for each user whose ratings, or the ratings and neighbours of
+        whose candidate movies changed since the last computation,
+        generate recommendations and store them
+        :param user_ids: collection of user ids, only these users are considered if given
         :return: None
         """
-        users = self.db.get_users()
+        self.metrics.reset()
+        dirty_users = self.db.get_dirty_users(self.USER_RATINGS_CRITERION, user_ids, self.store is not None)
+
+        if self.workers > 1 and len(dirty_users) > self.USER_CHUNK_SIZE:
+            self._update_in_parallel(dirty_users)
+        else:
+            for state in dirty_users:
+                user_id = state[0]
+                logging.info("initialise recommending process for user: " + str(user_id))
+
+                with self.metrics.user(user_id):
+                    recommender_list = self._get_single_user_recommendations(user_id)
+
+                    self.db.save_recommendations(recommender_list, user_id)
+                    self.db.save_recommendation_state([state])
 
-        for user in users:
-            user_id = user['id']
-            logging.info("initialise recommending process for user: " + str(user_id))
+                logging.info(str(len(recommender_list)) + " movies stored and recommended.")
+            logging.info(str(len(dirty_users)) + " users recomputed.")
 
-            recommender_list = self._get_single_user_recommendations(user_id)
+        skipped = len(self.db.get_users() if user_ids is None else user_ids) - len(dirty_users)
+        logging.info(str(skipped) + " unchanged users skipped.")
+        self._report_metrics()
+
+    def _report_metrics(self):
+        """
+        log the metrics of the run, and write them to the metrics file
+        :return: None
+        """
+        self.metrics.log_summary()
+        if self.metrics_path is not None:
+            self.metrics.write(self.metrics_path)
+
+    def recommend_for_user(self, user_id, limit=RECOMMEND_LIMIT):
+        """
+        recommendations of one user computed on demand, without storing
+        them, e.g. right after the user registered or rated a movie.
+        Neighbours, public ratings, favourite movies and user scales are
+        served from memory once warm, the latter two as long as the rating
+        version of the user is unchanged, so that a warm call reads that
+        version only. Users without favourite movies get the popular movies
+        :param user_id: integer
+        :param limit: integer, maximum number of recommendations
+        :return: list of [movie id, predicted score], best first
+        """
+        started = time.time()
+
+        version = self.db.get_rating_version(user_id)
+        cached = self.seed_cache.get(user_id)
+        if cached is None or cached[0] != version:
+            cached = (version, self._generate_recommend_seeds(self.db.get_user_history(user_id)))
+            self.seed_cache[user_id] = cached
+        seeds = cached[1]
+        candidates = self._generate_similar_movies_new(seeds) if seeds else set()
+
+        if not candidates:  # cold start
+            if self.popular_movies is None or started - self.popular_movies[0] > self.RATING_CACHE_TTL:
+                popular = {}
+                for movie_id, score in self.db.get_10_popular_movies():  # one row per rating source
+                    popular.setdefault(movie_id, score)
+                self.popular_movies = (started, [[movie_id, score] for movie_id, score in popular.items()])
+            recommend_list = self.popular_movies[1][:limit]
+        else:
+            public_ratings = self._get_cached_rating_vectors(candidates)
+            scale = self._get_cached_scale(user_id, version)
+
+            movie_ids = [movie_id for movie_id in candidates
+                         if movie_id in public_ratings and public_ratings[movie_id]['count'] == 3]
+            recommend_list = []
+            if movie_ids:
+                regressors = numpy.array([public_ratings[movie_id]['scores'] for movie_id in movie_ids],
+                                         dtype=numpy.float64)
+                if scale.coefficients is not None:
+                    scores = regressors.dot(scale.coefficients) + scale.intercept
+                else:  # same fallback as UserScale.predict_user_score
+                    scores = regressors.mean(axis=1)
+                recommend_list = [[movie_id, float(score)] for movie_id, score in zip(movie_ids, scores)
+                                  if self.RECOMMEND_CRITERION < score <= self.ANOMALY_CRITERION]
+            recommend_list = heapq.nlargest(limit, recommend_list, key=lambda recommendation: recommendation[1])
+
+        elapsed = time.time() - started
+        if elapsed > self.LATENCY_BUDGET:
+            logging.warning("recommendations of user " + str(user_id) + " took " + str(round(elapsed * 1000)) +
+                            "ms, over the " + str(round(self.LATENCY_BUDGET * 1000)) + "ms budget")
+        return recommend_list
+
+    def _get_cached_rating_vectors(self, movie_ids):
+        """
+        public ratings of the movies, only those missing from the cache
+        or cached for longer than RATING_CACHE_TTL are loaded
+        :param movie_ids: collection of movie ids
+        :return: dictionary, as returned by DatabaseHandler.get_public_rating_vectors
+        """
+        now = time.time()
+        expired = [movie_id for movie_id in movie_ids if movie_id not in self.rating_cache or
+                   now - self.rating_cache[movie_id][0] > self.RATING_CACHE_TTL]
 
-            self.db.save_recommendations(recommender_list, user_id)
+        if expired:
+            loaded = self.db.get_public_rating_vectors(expired)
+            for movie_id in expired:
+                self.rating_cache[movie_id] = (now, loaded.get(movie_id))
 
-            logging.info(str(len(recommender_list)) + " movies stored and recommended.")
+            outdated = datetime.now() - timedelta(days=2)
+            self.refresh_queue.enqueue([movie_id for movie_id, ratings in loaded.items()
+                                        if ratings['count'] == 3 and ratings['updated_at'] < outdated])
+
+        return {movie_id: self.rating_cache[movie_id][1] for movie_id in movie_ids
+                if self.rating_cache[movie_id][1] is not None}
+
+    def _get_cached_scale(self, user_id, version):
+        """
+        user scale, rebuilt only when the rating version of the user
+        changed. A refitted scale is not stored, the read path does not write
+        :param user_id: integer
+        :param version: integer, current rating version of the user
+        :return: UserScale
+        """
+        cached = self.scale_cache.get(user_id)
+        if cached is not None and cached.version == version:
+            return cached
+
+        scale = UserScale(user_id, self.db, save=False)
+        self.scale_cache[user_id] = scale
+        return scale
+
+    def _update_in_parallel(self, dirty_users):
+        """
+        split the users into chunks recommended by worker processes, each
+        with its own recommender and connection. Workers return the
+        recommendations, which are written in bulk by this process as
+        chunks complete; users that failed or timed out are left dirty and
+        retried by the next run
+
+        workers are started from a fork server rather than forked from
+        this process, whose refresh threads may hold locks the copies would
+        never release. If no chunk completes for CHUNK_TIMEOUT seconds, e.g.
+        a worker died or is stuck where the user timeout cannot interrupt
+        it, the workers are terminated and their users left dirty
+        :param dirty_users: list, as returned by DatabaseHandler.get_dirty_users
+        :return: None
+        """
+        chunks = [dirty_users[start:start + self.USER_CHUNK_SIZE]
+                  for start in range(0, len(dirty_users), self.USER_CHUNK_SIZE)]
+        recomputed = 0
+
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([__name__])
+        pool = context.Pool(self.workers, _initialise_worker,
+                            (type(self), self.store.path if self.store is not None else None, self.limit,
+                             self.db_factory))
+        try:
+            chunk_results = pool.imap_unordered(_recommend_chunk, chunks)
+            for _ in chunks:
+                try:
+                    results, _, outdated, (users, totals) = chunk_results.next(self.CHUNK_TIMEOUT)
+                except multiprocessing.TimeoutError:
+                    logging.error("no chunk completed for " + str(self.CHUNK_TIMEOUT) + "s, terminating the workers")
+                    break
+                except Exception:  # its users are retried by the next run
+                    logging.exception("failed to recommend a chunk of users")
+                    continue
+
+                rows = [(state[0], movie_id, score)
+                        for state, recommend_list in results for movie_id, score in recommend_list]
+                self.db.save_all_recommendations(rows, [state[0] for state, _ in results])
+                self.db.save_recommendation_state([state for state, _ in results])
+                self.refresh_queue.enqueue(outdated)
+                self.metrics.merge(users, totals)  # including the refreshes queued by the worker
+
+                recomputed += len(results)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        logging.info(str(recomputed) + " users recomputed by " + str(self.workers) + " workers, " +
+                     str(len(dirty_users) - recomputed) + " failed.")
 
     def _get_single_user_recommendations(self, user_id):
         """
@@ -59,16 +275,19 @@ class Recommender:
         :return: list
         """
         logging.debug("STEP 1: get user favorite movies")
-        user_history = self.db.get_user_history(user_id)
-        similarity_seeds = self._generate_recommend_seeds(user_history)
+        with self.metrics.stage('seeds'):
+            user_history = self.db.get_user_history(user_id)
+            similarity_seeds = self._generate_recommend_seeds(user_history)
         logging.debug(str(len(similarity_seeds)) + " favorite movies found.")
 
         logging.debug("STEP 2: get similar movies")
-        similar_list = self._generate_similar_movies_new(similarity_seeds)
+        with self.metrics.stage('neighbours'):
+            similar_list = self._generate_similar_movies_new(similarity_seeds)
         logging.debug(str(len(similar_list)) + " similar movies found.")
 
         logging.debug("STEP 3: get good movies")
-        recommend_list = self._generate_recommend_list(similar_list, user_id)
+        with self.metrics.stage('scoring'):
+            recommend_list = self._generate_recommend_list(similar_list, user_id)
         logging.debug(str(len(recommend_list)) + " potentially good movies found.")
 
         return recommend_list
@@ -80,12 +299,10 @@ class Recommender:
         :param user_list: list
         :return: list
         """
-        result = set()
-        for seed in user_list:
-            similar_movies = self.db.get_similar_movies_by_id(seed)
-            result |= set([movie[0] for movie in similar_movies])
+        if self.store is not None and self.store.refresh():  # picks up newly published versions
+            return self.store.get_neighbours(user_list, self.NEIGHBOUR_CRITERION)
 
-        return result
+        return self.db.get_neighbours_by_ids(list(user_list), self.NEIGHBOUR_CRITERION)
 
     def _generate_recommend_seeds(self, user_pool):
         """
@@ -104,25 +321,30 @@ class Recommender:
     def _generate_recommend_list(self, similar_list, user_id):
         logging.debug("initialising predicting process ...")
 
-        scale = UserScale(user_id)
+        scale = UserScale(user_id, self.db)
 
         recommend_list = []
 
         logging.debug("size of similar list: " + str(len(similar_list)))
+        public_ratings = self.db.get_public_rating_vectors(list(similar_list))
+
+        # check rating relevancy, ratings of all three sources older than two days are re-extracted
+        # in the background, the current ratings are used in the meantime
+        outdated = [potential for potential, ratings in public_ratings.items()
+                    if ratings['count'] == 3 and ratings['updated_at'] < datetime.now() - timedelta(days=2)]
+        if outdated:
+            queued = self.refresh_queue.enqueue(outdated)
+            self.metrics.increment('refreshes_queued', queued)
+            logging.debug(str(len(outdated)) + " ratings may be outdated, " + str(queued) + " queued for re-extraction")
+
         for potential in similar_list:
-            public_ratings = self.db.get_public_rating_dict(potential)
+            ratings = public_ratings.get(potential)
 
-            if len(public_ratings) == 0:
+            if ratings is None:
                 continue
 
-            if len(public_ratings) == 3:
-                # check rating relevancy, pick any updated date for one movie
-                if public_ratings[0]['updated_at'] < datetime.now() - timedelta(days=2):
-                    logging.debug("rating may be outdated, re-extracting ratings ...")
-                    self.controller.update_single_movie_rating(potential)
-                    public_ratings = self.db.get_public_rating_dict(potential)
-
-                regressors = self._construct_regressors(public_ratings)
+            if ratings['count'] == 3:
+                regressors = self._construct_regressors(ratings)
                 expected_score = scale.predict_user_score(regressors)[0]
 
                 if expected_score > self.ANOMALY_CRITERION:
@@ -131,18 +353,65 @@ class Recommender:
                 if expected_score > self.RECOMMEND_CRITERION:
                     recommend_list.append([potential, expected_score])
 
-        return recommend_list
+        return heapq.nlargest(self.limit, recommend_list, key=lambda recommendation: recommendation[1])
 
     @staticmethod
     def _construct_regressors(public_ratings):
-        regressors = [0, 0, 0]
-        for rating in public_ratings:
-            if rating['source_id'] == '1':
-                regressors[0] = rating['score']
-            elif rating['source_id'] == '2':
-                regressors[1] = rating['score']
-            elif rating['source_id'] == '3':
-                regressors[2] = rating['score']
-        return regressors
-
-
+        """
+        regressors of the user scale, IMDb, Douban and Trakt scores,
+        0 for a missing source
+        :param public_ratings: dictionary, as returned by get_public_rating_vectors
+        :return: list
+        """
+        return [score if score is not None else 0 for score in public_ratings['scores']]
+
+
+def _initialise_worker(recommender_class, store_path, limit, db_factory):
+    """
+    worker process initializer, the worker gets its own recommender and
+    connection, and collects outdated ratings for the parent. SIGALRM
+    is only handled between libpq calls, so the connection also has a
+    statement timeout for a query not to hold the worker past USER_TIMEOUT
+    :param recommender_class: class of the parent recommender
+    :param store_path: string, path of the NeighbourStore of the parent, None if it reads the database
+    :param limit: integer, number of recommendations kept per user
+    :param db_factory: callable taking PipelineMetrics and returning a DatabaseHandler
+    :return: None
+    """
+    store = NeighbourStore(store_path) if store_path is not None else None
+    recommender = recommender_class(store, RefreshRequests(), limit, db_factory=db_factory)
+    recommender.db.set_statement_timeout(recommender.USER_TIMEOUT)
+    _WORKER_CONTEXT['worker'] = recommender
+    signal.signal(signal.SIGALRM, _raise_timeout)
+
+
+def _raise_timeout(signum, frame):
+    raise TimeoutError("user took longer than " + str(Recommender.USER_TIMEOUT) + "s")
+
+
+def _recommend_chunk(dirty_users):
+    """
+    worker process entry point, recommends a chunk of users
+    :param dirty_users: list of states, as returned by DatabaseHandler.get_dirty_users
+    :return: list of (state, recommendations), list of failed user ids, list of outdated movie ids,
+             (per user metrics, total metrics) of the chunk
+    """
+    recommender = _WORKER_CONTEXT['worker']
+    results = []
+    failed_users = []
+
+    for state in dirty_users:
+        signal.setitimer(signal.ITIMER_REAL, recommender.USER_TIMEOUT)
+        try:
+            with recommender.metrics.user(state[0]):
+                results.append((state, recommender._get_single_user_recommendations(state[0])))
+        except Exception:  # one user must not fail the whole chunk
+            logging.exception("failed to recommend user " + str(state[0]))
+            recommender.db.conn.rollback()
+            failed_users.append(state[0])
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+    metrics = (recommender.metrics.users, recommender.metrics.totals)
+    recommender.metrics.reset()
+    return results, failed_users, recommender.refresh_queue.drain(), metrics
@@ -0,0 +1,92 @@
+"""
+    background re-extraction of outdated public ratings
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+import threading
+
+
+class RefreshQueue:
+    """
+        deduplicated queue of movies whose public ratings are outdated
+
+        re-extracting the ratings of a movie scrapes three websites, so it
+        is done by a pool of background threads while the recommender goes
+        on with the ratings it already has. A movie waiting or being
+        re-extracted is not queued a second time, and each thread owns its
+        controller, hence its database connection.
+    """
+
+    WORKER_COUNT = 4
+
+    def __init__(self, controller_factory, workers=WORKER_COUNT, metrics=None):
+        """
+        :param controller_factory: callable returning an ETLController
+        :param workers: integer, number of background threads
+        :param metrics: PipelineMetrics counting the refreshes, or None
+        """
+        self.controller_factory = controller_factory
+        self.metrics = metrics
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='rating-refresh')
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def enqueue(self, movie_ids):
+        """
+        queue movies for re-extraction, ignoring those already queued
+        :param movie_ids: iterable of movie ids
+        :return: integer, number of newly queued movies
+        """
+        with self.lock:
+            queued = [movie_id for movie_id in set(movie_ids) if movie_id not in self.pending]
+            self.pending.update(queued)
+
+        for movie_id in queued:
+            self.executor.submit(self._refresh, movie_id)
+        return len(queued)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.pending)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def _refresh(self, movie_id):
+        try:
+            if not hasattr(self.local, 'controller'):
+                self.local.controller = self.controller_factory()
+            self.local.controller.update_single_movie_rating(movie_id)
+            if self.metrics is not None:
+                self.metrics.increment('refreshes')
+        except Exception:  # a failing website must not stop the other refreshes
+            logging.exception("failed to re-extract ratings of " + movie_id)
+        finally:
+            with self.lock:
+                self.pending.discard(movie_id)
+
+
+class RefreshRequests:
+    """
+        stands in for a RefreshQueue in worker processes: the outdated
+        movies are only collected, and handed to the parent process which
+        owns the queue and its threads
+    """
+
+    def __init__(self):
+        self.movie_ids = set()
+
+    def enqueue(self, movie_ids):
+        movie_ids = set(movie_ids) - self.movie_ids
+        self.movie_ids.update(movie_ids)
+        return len(movie_ids)
+
+    def drain(self):
+        """
+        :return: list of the movie ids collected since the last drain
+        """
+        movie_ids = list(self.movie_ids)
+        self.movie_ids.clear()
+        return movie_ids
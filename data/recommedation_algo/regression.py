@@ -0,0 +1,92 @@
+"""
+    numpy implementation of the user scale regression, usable
+    for many users at once
+"""
+import numpy
+
+
+def predict_scores(regressors, coefficients, intercepts, fitted):
+    """
+    predicted user scores for many (user, movie) pairs, falling back
+    to the mean of the public ratings for users without a model
+    :param regressors: numpy array of shape (pairs, features), public ratings of the movie
+    :param coefficients: numpy array of shape (pairs, features), coefficients of the user
+    :param intercepts: numpy array of shape (pairs, )
+    :param fitted: boolean numpy array of shape (pairs, )
+    :return: numpy array of shape (pairs, )
+    """
+    predicted = numpy.einsum('ij,ij->i', regressors, coefficients) + intercepts
+    return numpy.where(fitted, predicted, regressors.mean(axis=1))
+
+
+def fit_batch_least_squares(groups, regressors, responses, group_count):
+    """
+    ordinary least squares with an intercept for many independent
+    groups of samples at once: the normal equations of every group are
+    accumulated with grouped reductions and solved in one stacked
+    numpy.linalg.solve call. Rank deficient groups are left unfitted
+    :param groups: integer numpy array of shape (n, ), group of every sample
+    :param regressors: numpy array of shape (n, features)
+    :param responses: numpy array of shape (n, )
+    :param group_count: integer
+    :return: numpy array of coefficients of shape (group_count, features),
+             numpy array of intercepts of shape (group_count, ),
+             boolean numpy array of shape (group_count, ), whether the group was fitted
+    """
+    return solve_statistics(*batch_statistics(groups, regressors, responses, group_count))
+
+
+def batch_statistics(groups, regressors, responses, group_count):
+    """
+    sufficient statistics of the least squares problem of every group,
+    X'X and X'y where X has a leading column of ones for the intercept
+    :param groups: integer numpy array of shape (n, ), group of every sample
+    :param regressors: numpy array of shape (n, features)
+    :param responses: numpy array of shape (n, )
+    :param group_count: integer
+    :return: numpy array of shape (group_count, features + 1, features + 1),
+             numpy array of shape (group_count, features + 1)
+    """
+    design = numpy.hstack([numpy.ones((len(responses), 1)), regressors])
+    width = design.shape[1]
+
+    gram = numpy.zeros((group_count, width, width))
+    moments = numpy.zeros((group_count, width))
+    numpy.add.at(gram, groups, design[:, :, None] * design[:, None, :])
+    numpy.add.at(moments, groups, design * responses[:, None])
+    return gram, moments
+
+
+def add_observation(gram, moments, regressors, response, weight=1.0):
+    """
+    rank-one update of the sufficient statistics of one group, in place
+    :param gram: numpy array of shape (features + 1, features + 1)
+    :param moments: numpy array of shape (features + 1, )
+    :param regressors: list or numpy array of shape (features, )
+    :param response: float
+    :param weight: float, -1 removes an observation added before
+    :return: None
+    """
+    design = numpy.concatenate([[1.0], numpy.asarray(regressors, dtype=numpy.float64)])
+    gram += weight * numpy.outer(design, design)
+    moments += weight * response * design
+
+
+def solve_statistics(gram, moments):
+    """
+    least squares solutions from the sufficient statistics of many groups
+    :param gram: numpy array of shape (groups, features + 1, features + 1)
+    :param moments: numpy array of shape (groups, features + 1)
+    :return: numpy array of coefficients of shape (groups, features),
+             numpy array of intercepts of shape (groups, ),
+             boolean numpy array of shape (groups, ), whether the group was fitted
+    """
+    group_count, width = moments.shape
+    solutions = numpy.zeros((group_count, width))
+    fitted = numpy.zeros(group_count, dtype=bool)
+    if group_count:
+        fitted = numpy.linalg.matrix_rank(gram, hermitian=True) == width
+    if fitted.any():
+        solutions[fitted] = numpy.linalg.solve(gram[fitted], moments[fitted][:, :, None])[:, :, 0]
+
+    return solutions[:, 1:], solutions[:, 0], fitted
@@ -2,66 +2,134 @@
     Using multi-linear regression to calculate the weight of each rating
     source for one user
 """
-from sklearn import linear_model, exceptions
 from recommedation_algo.database import DatabaseHandler
-from data.public_data.controller import ETLController
+from recommedation_algo.regression import add_observation, batch_statistics, solve_statistics
 
 import numpy
 
 
 class UserScale:
+    """
+        the sufficient statistics of the regression, X'X and X'y, are
+        stored along with the version of the training set they were built
+        from, the rating version of the user. The notify triggers bump it
+        whenever a rating of the user, or the score of a movie they rated,
+        changes, so checking the statistics is a primary key lookup, and
+        solving them a 4x4 solve instead of a fit on the whole history
+
+        a notified rating change then costs reading the statistics and the
+        public ratings of one movie, a rank-one downdate of the previous
+        score and update with the new one, and a 4x4 solve, whatever the
+        length of the history. A rating is only applied when the statistics
+        are exactly one version behind it: the public ratings of the movie
+        did not change in between, so the downdate removes what was added
+    """
 
     DEFAULT_WEIGHT = 1 / 3
 
-    def __init__(self, user_id):
+    def __init__(self, user_id, db=None, rating_change=None, save=True):
+        """
+        :param user_id: integer
+        :param db: DatabaseHandler
+        :param rating_change: (movie id, score, previous score, rating version) of a rating the user
+                              just added, updated or removed, as notified, the scale is then updated
+                              by update_rating
+        :param save: boolean, store fitted statistics, readers on a latency budget do not write
+        """
         self.user_id = user_id
-        self.db = DatabaseHandler()
-        self.controller = ETLController()
-
-        self.model = linear_model.LinearRegression()
-        self._fit_model()
-
-    def _fit_model(self):
+        self.db = db or DatabaseHandler()
+        self.save = save
+
+        self.coefficients = None
+        self.intercept = None
+        self.version = None  # of the training set the scale was solved from, None if unknown
+        if rating_change is not None:
+            self.update_rating(*rating_change)
+        else:
+            self._load_model()
+
+    def update_rating(self, movie_id, score, old_score, version):
         """
-        fit public ratings and user rating to
-        a linear regression model
+        update the scale after the user added, updated or removed a
+        rating, the change being already stored. The statistics are
+        rebuilt from the whole history instead if they are not exactly one
+        version behind, e.g. when a notification was missed
+        :param movie_id: string
+        :param score: float, None if the rating was removed
+        :param old_score: float, None if the rating was added
+        :param version: integer, rating version of the user after the change
         :return: None
         """
-        user_rating_records = self.db.get_user_history(self.user_id)
-
-        if len(user_rating_records) == 0:  # no previous watching history
+        statistics = self.db.get_scale_statistics(self.user_id)
+        if statistics is None or statistics['version'] != version - 1:
+            self._load_model()
             return
 
-        regressors = []
-        responses = []
-
-        for record in user_rating_records:
-            current_movie_id = record[0]
+        gram = numpy.array(statistics['gram']).reshape(len(statistics['moments']), -1)
+        moments = numpy.array(statistics['moments'])
 
-            # regressors
-            public_rating_records = self.db.get_public_rating(current_movie_id)
+        ratings = self.db.get_public_rating_vectors([movie_id]).get(movie_id)
+        if ratings is not None and ratings['count'] == 3:  # otherwise not a data point, as in the full fit
+            if old_score is not None:
+                add_observation(gram, moments, ratings['scores'], old_score, weight=-1)
+            if score is not None:
+                add_observation(gram, moments, ratings['scores'], score)
 
-            if len(public_rating_records) < 3:
-                continue
+        self.db.save_scale_statistics(self.user_id, gram.ravel().tolist(), moments.tolist(), version)
+        self._solve(gram, moments, version)
 
-            if not public_rating_records:  # rating not available
-                self.controller.update_single_movie_rating(current_movie_id)  # update rating
-                public_rating_records = self.db.get_public_rating(current_movie_id)
+    def _load_model(self):
+        """
+        solve the stored statistics if the training set did not change
+        since they were built, otherwise fit and store new ones
+        :return: None
+        """
+        version = self.db.get_rating_version(self.user_id)
+        statistics = self.db.get_scale_statistics(self.user_id)
 
-            public_rating_records = sorted(public_rating_records, key=lambda x: x[1])  # sort records -> replace by sql
-            current_set = []
-            for regressor in public_rating_records:
-                current_set.append(regressor[3])
+        if statistics is not None and statistics['version'] == version:
+            gram = numpy.array(statistics['gram']).reshape(len(statistics['moments']), -1)
+            self._solve(gram, numpy.array(statistics['moments']), version)
+            return
 
-            if None in current_set:  # skip invalid data points
-                continue
+        self._fit_model(version)
 
-            regressors.append(current_set)
+    def _fit_model(self, version):
+        """
+        fit public ratings and user rating to
+        a linear regression model, storing its statistics if required
+        and unless the training set changed while it was read
+        :param version: integer, rating version of the user before reading the training set
+        :return: None
+        """
+        _, regressors, responses = self.db.get_scale_training_data([self.user_id])
+
+        gram, moments = batch_statistics(
+            numpy.zeros(len(responses), dtype=numpy.int64), regressors, responses, 1
+        )
+        if self.db.get_rating_version(self.user_id) != version:  # the statistics may already include a change
+            version = None
+        elif self.save:
+            self.db.save_scale_statistics(self.user_id, gram[0].ravel().tolist(), moments[0].tolist(), version)
+        self._solve(gram[0], moments[0], version)
+
+    def _solve(self, gram, moments, version):
+        """
+        solve the regression from its statistics
+        :param gram: numpy array of shape (4, 4)
+        :param moments: numpy array of shape (4, )
+        :param version: integer, of the training set, None if unknown
+        :return: None
+        """
+        coefficients, intercepts, fitted = solve_statistics(gram[None], moments[None])
 
-            # response
-            user_rating = record[1]
-            responses.append(user_rating)
-        self.model.fit(regressors, responses)
+        self.version = version
+        if fitted[0]:  # rank deficient histories fall back to the mean
+            self.coefficients = coefficients[0]
+            self.intercept = float(intercepts[0])
+        else:
+            self.coefficients = None
+            self.intercept = None
 
     def predict_user_score(self, public_ratings):
         """
@@ -69,11 +137,9 @@ class UserScale:
         history of rating, or average in the event
         that there is no history available
         :param public_ratings: list
-        :return: float
+        :return: numpy array holding one float
         """
-        try:
-            self.model.predict([public_ratings])
-        except exceptions.NotFittedError:
-            return numpy.mean(public_ratings)
+        if self.coefficients is None:
+            return numpy.array([numpy.mean(public_ratings)])
 
-        return self.model.predict([public_ratings])
+        return numpy.array([numpy.dot(public_ratings, self.coefficients) + self.intercept])
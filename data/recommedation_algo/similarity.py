@@ -1,5 +1,19 @@
+from recommedation_algo.engine import SimilarityEngine
+from recommedation_algo.features import FeatureExtractor
+from recommedation_algo.index import InvertedIndex
+from recommedation_algo.lsh import MinHashLSH
+from recommedation_algo.neighbours import TopKNeighbours
+from recommedation_algo.store import NeighbourStore, DEFAULT_PATH
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import recommedation_algo.database as database
 import logging
+import multiprocessing
+import numpy
+import time
+
+# state of the running job, inherited by the forked shard workers
+_SHARD_CONTEXT = {}
 
 
 class MovieSimilarity:
@@ -18,116 +32,424 @@ class MovieSimilarity:
     DIRECTOR_WEIGHT = 0.30
     RUNTIME_WEIGHT = 0.10
 
-    def __init__(self):
-        self.db = database.DatabaseHandler()
+    BLOCK_SIZE = 64  # history movies scored against the whole movie pool at once
+
+    MIN_SCORE = 0.4  # lowest similarity read back by DatabaseHandler.get_similar_movies_by_id
+
+    WRITE_BATCH_SIZE = 100000  # rows merged into the similarity table per transaction
+
+    NEIGHBOUR_COUNT = 100  # neighbours kept per history movie in top-k mode
+
+    PAIR_CHUNK_SIZE = 100000  # candidate pairs scored at once in approximate mode
+
+    RECALL_SAMPLE_SIZE = 100  # movies checked against exact scores in approximate mode
+
+    # watermark roles of movies already scored by a previous run
+    HISTORY_WATERMARK = 'history'
+    MOVIE_POOL_WATERMARK = 'pool'
+
+    def __init__(self, db=None, db_factory=None):
+        """
+        :param db: DatabaseHandler, or any object providing the same methods
+        :param db_factory: callable returning the connection of each shard worker, DatabaseHandler if None
+        """
+        self.db = db or database.DatabaseHandler()
+        self.db_factory = db_factory or database.DatabaseHandler
+        self.extractor = FeatureExtractor()
+        self.engine = SimilarityEngine({
+            'genre': self.GENRE_WEIGHT,
+            'actors': self.ACTOR_WEIGHT,
+            'director': self.DIRECTOR_WEIGHT
+        }, self.RUNTIME_WEIGHT, self.extractor)
 
-    def calculate_similarity_table(self):
+    def calculate_similarity_table(self, incremental=False, batch_size=WRITE_BATCH_SIZE, min_score=None,
+                                   top_k=None, workers=1):
         """
         main logic for calculating similarity and
         storing the results
+
+        in incremental mode, movies recorded in the watermark table by
+        a previous run are not scored again: only new history movies are
+        scored against the whole movie pool, and the remaining history
+        movies against new movies in the pool
+
+        with a minimum score, only pairs that share enough features to
+        reach it are scored, using an inverted index of the movie pool,
+        and only pairs reaching it are stored
+
+        with top_k, instead of writing every pair to the similarity table,
+        only the k most similar movies of each history movie are kept,
+        as one row per movie in the similarity_neighbours table
+
+        with more than one worker, the history movies are split into
+        shards scored by a pool of processes
+        :param incremental: boolean
+        :param batch_size: integer, rows written per transaction
+        :param min_score: float or None
+        :param top_k: integer or None
+        :param workers: integer
         :return:
         """
         logging.info("initialise similarity matrix calculation ...")
+        self.extractor.clear()
         user_history_objects = self._get_user_histories()
         movie_objects = self._get_compared_movies()
         logging.info("user history object count: " + str(len(user_history_objects)))
         logging.info("movie objects count: " + str(len(movie_objects)))
 
-        for user_history_object in user_history_objects:
-            for movie_object in movie_objects:
-                first_movie_id = user_history_object['movie_id']
-                second_movie_id = movie_object['movie_id']
+        self.db.create_tables()
+        writer_options = {'top_k': top_k, 'merge': incremental, 'batch_size': batch_size}
 
-                if first_movie_id != second_movie_id:
-                    current_similarity = self._calculate_similarity(user_history_object, movie_object)
-                    self.db.save_similarity(first_movie_id, second_movie_id, current_similarity)
+        if incremental:
+            scored_history = self.db.get_scored_movie_ids(self.HISTORY_WATERMARK)
+            scored_movies = self.db.get_scored_movie_ids(self.MOVIE_POOL_WATERMARK)
+
+            new_histories = [item for item in user_history_objects if item.movie_id not in scored_history]
+            old_histories = [item for item in user_history_objects if item.movie_id in scored_history]
+            new_movies = [item for item in movie_objects if item.movie_id not in scored_movies]
+            logging.info(str(len(new_histories)) + " new history movies, " +
+                         str(len(new_movies)) + " new pool movies.")
+
+            self._calculate_similarity_pairs(new_histories, movie_objects, writer_options, min_score, workers)
+            self._calculate_similarity_pairs(old_histories, new_movies, writer_options, min_score, workers)
+
+            self.db.save_scored_movie_ids([item.movie_id for item in new_histories], self.HISTORY_WATERMARK)
+            self.db.save_scored_movie_ids([item.movie_id for item in new_movies], self.MOVIE_POOL_WATERMARK)
+        else:
+            self._calculate_similarity_pairs(user_history_objects, movie_objects, writer_options, min_score, workers)
 
         logging.info("current iteration complete.")
 
+    def publish_neighbour_store(self, path=DEFAULT_PATH):
+        """
+        export the stored neighbour lists as a new version of the
+        memory-mapped neighbour store read by the recommender. The lists
+        changed since the previous version are then marked as published,
+        for the recommender to recompute the users depending on them
+        :param path: string
+        :return: None
+        """
+        exported_at = self.db.get_timestamp()
+        neighbour_lists = self.db.get_all_neighbour_lists()
+        version = NeighbourStore.publish(neighbour_lists, path)
+        self.db.mark_neighbour_lists_published(exported_at)
+        logging.info(str(len(neighbour_lists)) + " neighbour lists published to " + version)
+
+    def calculate_catalog_similarity(self, batch_size=WRITE_BATCH_SIZE, min_score=MIN_SCORE, top_k=None,
+                                     lsh=None):
+        """
+        approximate similarity of every movie of the pool against every
+        other one, so that movies nobody has rated also get neighbours.
+
+        candidates are the pairs colliding in the MinHash LSH buckets,
+        only those are scored exactly, and pairs reaching min_score stored.
+        The recall against exact scores is measured on a sample of movies.
+        :param batch_size: integer, rows written per transaction
+        :param min_score: float
+        :param top_k: integer or None
+        :param lsh: MinHashLSH or None for the default parameters
+        :return: float, recall on the sample
+        """
+        logging.info("initialise approximate catalog similarity calculation ...")
+        self.extractor.clear()
+        movie_objects = self._get_compared_movies()
+        if len(movie_objects) < 2:
+            return 1.0
+
+        lsh = lsh or MinHashLSH()
+        movies = self.engine.encode(movie_objects)
+        firsts, seconds = lsh.candidate_pairs(lsh.signatures(self.engine, movies))
+        logging.info(str(len(firsts)) + " candidate pairs out of " +
+                     str(len(movies) * (len(movies) - 1) // 2) + ".")
+
+        self.db.create_tables()
+        writer = self._create_writer(self.db, top_k, False, batch_size)
+        movie_ids = numpy.array(movies.movie_ids, dtype=object)
+        found = set()
+
+        for start in range(0, len(firsts), self.PAIR_CHUNK_SIZE):
+            first = firsts[start:start + self.PAIR_CHUNK_SIZE]
+            second = seconds[start:start + self.PAIR_CHUNK_SIZE]
+            forward = self.engine.score_pairs(movies, movies, first, second)
+            backward = self.engine.score_pairs(movies, movies, second, first)
+
+            passed_forward = forward >= min_score
+            passed_backward = backward >= min_score
+
+            for row in numpy.flatnonzero(passed_forward | passed_backward):
+                found.add((first[row], second[row]))
+                if top_k is not None:  # neighbour lists are directed, each direction is kept on its own score
+                    if passed_forward[row]:
+                        writer.add(movie_ids[first[row]], movie_ids[second[row]], float(forward[row]))
+                    if passed_backward[row]:
+                        writer.add(movie_ids[second[row]], movie_ids[first[row]], float(backward[row]))
+                elif passed_forward[row]:
+                    writer.add(movie_ids[first[row]], movie_ids[second[row]], float(forward[row]))
+                else:  # the pair writer stores pairs once, with the score reaching min_score
+                    writer.add(movie_ids[second[row]], movie_ids[first[row]], float(backward[row]))
+        writer.flush()
+
+        recall = self._sample_recall(movies, found, min_score)
+        logging.info("recall on " + str(min(self.RECALL_SAMPLE_SIZE, len(movies))) + " sampled movies: " +
+                     str(round(recall, 4)))
+        return recall
+
+    def _sample_recall(self, movies, found, min_score):
+        """
+        share of the pairs reaching min_score, for a random sample
+        of movies, that were found by the approximate search
+        :param movies: EncodedMovies
+        :param found: set of (first row, second row), first < second
+        :param min_score: float
+        :return: float
+        """
+        sample = numpy.random.choice(len(movies), min(self.RECALL_SAMPLE_SIZE, len(movies)), replace=False)
+        expected = 0
+        recalled = 0
+
+        for row in sample:
+            exact = self.engine.score(self.engine.take(movies, [row]), movies)[0]
+            reverse = self.engine.score(movies, self.engine.take(movies, [row]))[:, 0]
+            for other in numpy.flatnonzero((exact >= min_score) | (reverse >= min_score)):
+                if other == row:
+                    continue
+                expected += 1
+                if (min(row, other), max(row, other)) in found:
+                    recalled += 1
+
+        return recalled / expected if expected else 1.0
+
+    def _calculate_similarity_pairs(self, user_history_objects, movie_objects, writer_options, min_score=None,
+                                    workers=1):
+        """
+        score every history movie against every given movie
+        and store the results
+        :param user_history_objects: list of MovieFeatures
+        :param movie_objects: list of MovieFeatures
+        :param writer_options: dictionary, arguments of _create_writer
+        :param min_score: float or None
+        :param workers: integer
+        :return: None
+        """
+        if not user_history_objects or not movie_objects:
+            return
+
+        history = self.engine.encode(user_history_objects)
+        movies = self.engine.encode(movie_objects)
+        index = InvertedIndex(self.engine, movies) if min_score is not None else None
+
+        if workers > 1:
+            self._calculate_shards(history, movies, index, writer_options, min_score, workers)
+            return
+
+        writer = self._create_writer(self.db, **writer_options)
+        self._score_movies(history, movies, index, writer, min_score)
+        writer.flush()
+
+    def _calculate_shards(self, history, movies, index, writer_options, min_score, workers):
+        """
+        split the history movies into one shard per worker process.
+        The encoded movies and the index are built before the workers
+        are forked, so they share those buffers read-only; each worker
+        opens its own connection, from db_factory, and writer.
+        :param history: EncodedMovies
+        :param movies: EncodedMovies
+        :param index: InvertedIndex or None
+        :param writer_options: dictionary
+        :param min_score: float or None
+        :param workers: integer
+        :return: None
+        """
+        for feature in self.engine.FEATURES:
+            self.engine.incidence_matrix(movies, feature)  # cache before forking
+
+        _SHARD_CONTEXT.update({
+            'similarity': self,
+            'history': history,
+            'movies': movies,
+            'index': index,
+            'writer_options': writer_options,
+            'min_score': min_score
+        })
+        bounds = numpy.linspace(0, len(history), workers + 1).astype(int)
+        started = time.time()
+
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+                futures = [executor.submit(_score_shard, shard, bounds[shard], bounds[shard + 1])
+                           for shard in range(workers) if bounds[shard] < bounds[shard + 1]]
+                for future in as_completed(futures):
+                    shard, size, elapsed = future.result()
+                    logging.info("shard " + str(shard) + ": " + str(size) + " history movies in " +
+                                 str(round(elapsed, 2)) + "s")
+        finally:
+            _SHARD_CONTEXT.clear()
+
+        logging.info(str(len(futures)) + " shards completed in " + str(round(time.time() - started, 2)) + "s")
+
+    def _score_movies(self, history, movies, index, writer, min_score):
+        """
+        score history movies against the movies, either all pairs
+        or the candidates of the index when it prunes enough of them,
+        and pass those reaching min_score to the writer
+        :param history: EncodedMovies
+        :param movies: EncodedMovies
+        :param index: InvertedIndex or None
+        :param writer: SimilarityWriter or TopKNeighbours
+        :param min_score: float or None
+        :return: None
+        """
+        if index is not None and index.prunes(min_score):
+            self._calculate_candidate_pairs(history, movies, index, writer, min_score)
+            return
+
+        movie_ids = numpy.array(movies.movie_ids, dtype=object)
+
+        for offset, block in self.engine.score_blocks(history, movies, self.BLOCK_SIZE):
+            for row, similarities in enumerate(block):
+                self._add_similarities(writer, history.movie_ids[offset + row], movie_ids, similarities, min_score)
+
+    def _calculate_candidate_pairs(self, history, movies, index, writer, min_score):
+        """
+        score blocks of history movies against the candidates given
+        by an inverted index of the movies, keeping pairs above min_score
+        :param history: EncodedMovies
+        :param movies: EncodedMovies
+        :param index: InvertedIndex
+        :param writer: SimilarityWriter or TopKNeighbours
+        :param min_score: float
+        :return: None
+        """
+        movie_ids = numpy.array(movies.movie_ids, dtype=object)
+        candidate_count = 0
+
+        for start in range(0, len(history), self.BLOCK_SIZE):
+            end = min(start + self.BLOCK_SIZE, len(history))
+            rows, candidates = index.candidate_pairs(history, start, end, min_score)
+            candidate_count += len(rows)
+            similarities = self.engine.score_pairs(history, movies, rows, candidates)
+
+            bounds = numpy.searchsorted(rows, numpy.arange(start, end + 1))
+            for row in range(start, end):
+                pairs = slice(bounds[row - start], bounds[row - start + 1])
+                self._add_similarities(writer, history.movie_ids[row], movie_ids[candidates[pairs]],
+                                       similarities[pairs], min_score)
+
+        logging.info(str(candidate_count) + " of " + str(len(history) * len(movies)) + " pairs scored.")
+
+    @staticmethod
+    def _add_similarities(writer, movie_id, neighbour_ids, similarities, min_score):
+        """
+        pass the similarities of one movie to the writer, except
+        against itself and below min_score
+        :param writer: SimilarityWriter or TopKNeighbours
+        :param movie_id: string
+        :param neighbour_ids: numpy array of movie ids
+        :param similarities: numpy array
+        :param min_score: float or None
+        :return: None
+        """
+        kept = neighbour_ids != movie_id
+        if min_score is not None:
+            kept &= similarities >= min_score
+        writer.add_many(movie_id, neighbour_ids[kept], similarities[kept])
+
+    @staticmethod
+    def _create_writer(db, top_k, merge, batch_size):
+        if top_k is not None:
+            return TopKNeighbours(db, top_k, merge=merge)
+        return db.get_similarity_writer(batch_size)
+
     def _get_user_histories(self):
         logging.debug("generating user histories ...")
-        user_histories = self.db.get_user_history_object()
+        user_histories = self.extractor.extract(self.db.get_user_history_object())
         logging.debug(str(len(user_histories)) + " movies are found.")
         return user_histories
 
     def _get_compared_movies(self):
         logging.debug("generating movie pool ...")
-        movie_pool = self.db.get_movie_pool_object()
+        movie_pool = self.extractor.extract(self.db.get_movie_pool_object())
         logging.debug(str(len(movie_pool)) + " movies are found.")
         return movie_pool
 
-    def _calculate_similarity(self, first_movie_object, second_movie_object):
+    def _calculate_similarity(self, first_movie, second_movie):
         """
-        1. get a list of existing pairs, check repetition, skip repetition
-        2. calculate
-        3. return
-        :param first_movie_object:
-        :param second_movie_object:
-        :return:
+        similarity of two movies, the weighted sum of the
+        similarity of each of their features
+        :param first_movie: MovieFeatures
+        :param second_movie: MovieFeatures
+        :return: float
         """
-        genre_similarity = self._calculate_genre_similarity(first_movie_object['genre'],
-                                                            second_movie_object['genre'])
+        genre_similarity = self._calculate_genre_similarity(first_movie, second_movie)
 
-        actor_similarity = self._calculate_genre_similarity(first_movie_object['actors'],
-                                                            second_movie_object['actors'])
+        actor_similarity = self._calculate_actor_similarity(first_movie, second_movie)
 
-        director_similarity = self._calculate_genre_similarity(first_movie_object['director'],
-                                                            second_movie_object['director'])
+        director_similarity = self._calculate_director_similarity(first_movie, second_movie)
 
-        runtime_similarity = self._calculate_genre_similarity(first_movie_object['runtime'],
-                                                              second_movie_object['runtime'])
+        runtime_similarity = self._calculate_runtime_similarity(first_movie, second_movie)
 
         return genre_similarity + actor_similarity + runtime_similarity + director_similarity
 
-    def _calculate_genre_similarity(self, first_genre, second_genre):
+    def _calculate_genre_similarity(self, first_movie, second_movie):
         """
         calculate similarity of genres between two movies
         :return: float
         """
-        targets = self._tokenize_string(first_genre)
-        sources = self._tokenize_string(second_genre)
-        average_count = (len(targets) + len(sources)) / 2
-        similarity = len(set(sources).intersection(targets)) / average_count
+        similarity = self._dice_coefficient(first_movie.genre, second_movie.genre,
+                                            first_movie.genre_size, second_movie.genre_size)
         return self.GENRE_WEIGHT * similarity
 
-    def _calculate_actor_similarity(self, first_actor, second_actor):
+    def _calculate_actor_similarity(self, first_movie, second_movie):
         """
         calculate similarity of actors between two movies
-        :return:
+        :return: float
         """
-        targets = self._tokenize_string(first_actor)
-        sources = self._tokenize_string(second_actor)
-        average_count = (len(targets) + len(sources)) / 2
-        similarity = len(set(sources).intersection(targets)) / average_count
+        similarity = self._dice_coefficient(first_movie.actors, second_movie.actors,
+                                            first_movie.actors_size, second_movie.actors_size)
         return self.ACTOR_WEIGHT * similarity
 
-    def _calculate_director_similarity(self, first_director, second_director):
+    def _calculate_director_similarity(self, first_movie, second_movie):
         """
-        calculate similarity of actors between two movies
-        :return:
+        calculate similarity of directors between two movies
+        :return: float
         """
-        targets = self._tokenize_string(first_director)
-        sources = self._tokenize_string(second_director)
-        average_count = (len(targets) + len(sources)) / 2
-        similarity = len(set(sources).intersection(targets)) / average_count
+        similarity = self._dice_coefficient(first_movie.director, second_movie.director,
+                                            first_movie.director_size, second_movie.director_size)
         return self.DIRECTOR_WEIGHT * similarity
 
-    def _calculate_runtime_similarity(self, first_runtime, second_runtime):
+    def _calculate_runtime_similarity(self, first_movie, second_movie):
         """
         calculate similarity of runtime between two movies
         based on the difference in runtime as a percentage
         of the source movie
         :return: float
         """
-        target_runtime = int(first_runtime)
-        source_runtime = int(second_runtime)
-        difference = abs(target_runtime - source_runtime)
-        similarity = 1 - (difference / source_runtime)
+        difference = abs(first_movie.runtime - second_movie.runtime)
+        similarity = 1 - (difference / second_movie.runtime)
         return self.RUNTIME_WEIGHT * similarity
 
     @staticmethod
-    def _tokenize_string(genre):
-        tokens = genre.split(",")
-        return [token.strip() for token in tokens]
+    def _dice_coefficient(targets, sources, target_size, source_size):
+        average_count = (target_size + source_size) / 2
+        return len(sources & targets) / average_count
+
+
+def _score_shard(shard, start, end):
+    """
+    worker process entry point, scores one shard of history movies
+    :param shard: integer
+    :param start: integer
+    :param end: integer
+    :return: (shard, number of history movies, seconds)
+    """
+    started = time.time()
+    similarity = _SHARD_CONTEXT['similarity']
+    db = similarity.db_factory()  # the inherited connection stays untouched, it belongs to the parent
 
+    history = similarity.engine.subset(_SHARD_CONTEXT['history'], start, end)
+    writer = similarity._create_writer(db, **_SHARD_CONTEXT['writer_options'])
+    similarity._score_movies(history, _SHARD_CONTEXT['movies'], _SHARD_CONTEXT['index'], writer,
+                             _SHARD_CONTEXT['min_score'])
+    writer.flush()
 
+    return shard, int(end - start), time.time() - started
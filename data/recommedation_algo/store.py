@@ -0,0 +1,130 @@
+"""
+    read-only, memory-mapped store of the neighbour lists
+"""
+import numpy
+import os
+import shutil
+import tempfile
+import time
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'neighbour_store')
+
+
+class NeighbourStore:
+    """
+        neighbour lists laid out as flat numpy arrays:
+
+            movie_ids   sorted movie ids, every source and neighbour movie
+            offsets     neighbours of movie_ids[i] are at offsets[i]:offsets[i + 1]
+            neighbours  positions in movie_ids
+            scores      similarity of each neighbour
+
+        each published version is written to its own directory, and the
+        'current' symbolic link is swapped atomically to point to it.
+        Readers map the files without copying, and re-open the store
+        when the link has moved.
+    """
+
+    CURRENT = 'current'
+    KEPT_VERSIONS = 2  # the previous version may still be mapped by readers
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.version = None
+        self.movie_ids = None
+        self.offsets = None
+        self.neighbours = None
+        self.scores = None
+        self.refresh()
+
+    @classmethod
+    def publish(cls, neighbour_lists, path=DEFAULT_PATH):
+        """
+        write a new version of the store and make it the current one
+        :param neighbour_lists: dictionary, movie id -> (neighbour ids, scores)
+        :param path: string
+        :return: string, directory of the new version
+        """
+        movie_ids = set(neighbour_lists.keys())
+        for neighbour_ids, _ in neighbour_lists.values():
+            movie_ids.update(neighbour_ids)
+        movie_ids = numpy.array(sorted(movie_ids), dtype=bytes)
+        positions = {movie_id: position for position, movie_id in enumerate(movie_ids.tolist())}
+
+        counts = numpy.zeros(len(movie_ids), dtype=numpy.int64)
+        neighbours = []
+        scores = []
+        for movie_id in movie_ids.tolist():  # sorted, so lists are laid out in movie order
+            entry = neighbour_lists.get(movie_id.decode())
+            if entry is None:
+                continue
+            counts[positions[movie_id]] = len(entry[0])
+            neighbours.extend(positions[neighbour_id.encode()] for neighbour_id in entry[0])
+            scores.extend(entry[1])
+
+        offsets = numpy.zeros(len(movie_ids) + 1, dtype=numpy.int64)
+        numpy.cumsum(counts, out=offsets[1:])
+
+        os.makedirs(path, exist_ok=True)
+        version = tempfile.mkdtemp(prefix=str(int(time.time() * 1000000)) + '-', dir=path)  # sorts by age
+        numpy.save(os.path.join(version, 'movie_ids.npy'), movie_ids)
+        numpy.save(os.path.join(version, 'offsets.npy'), offsets)
+        numpy.save(os.path.join(version, 'neighbours.npy'), numpy.array(neighbours, dtype=numpy.int32))
+        numpy.save(os.path.join(version, 'scores.npy'), numpy.array(scores, dtype=numpy.float32))
+
+        link = os.path.join(path, cls.CURRENT + '.tmp')
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(os.path.basename(version), link)
+        os.replace(link, os.path.join(path, cls.CURRENT))
+
+        cls._remove_old_versions(path)
+        return version
+
+    def refresh(self):
+        """
+        map the current version, if it changed since the last call
+        :return: boolean, True if a version is available
+        """
+        link = os.path.join(self.path, self.CURRENT)
+        if not os.path.exists(link):
+            return False
+
+        version = os.path.realpath(link)
+        if version != self.version:
+            self.movie_ids = numpy.load(os.path.join(version, 'movie_ids.npy'), mmap_mode='r')
+            self.offsets = numpy.load(os.path.join(version, 'offsets.npy'), mmap_mode='r')
+            self.neighbours = numpy.load(os.path.join(version, 'neighbours.npy'), mmap_mode='r')
+            self.scores = numpy.load(os.path.join(version, 'scores.npy'), mmap_mode='r')
+            self.version = version
+        return True
+
+    def get_neighbours(self, movie_ids, threshold=0.4):
+        """
+        distinct neighbours of all given movies
+        :param movie_ids: list of strings
+        :param threshold: float, lowest similarity returned
+        :return: set of strings
+        """
+        if self.version is None or not movie_ids or len(self.movie_ids) == 0:
+            return set()
+
+        width = self.movie_ids.dtype.itemsize
+        keys = numpy.array([key for key in (movie_id.encode() for movie_id in movie_ids) if len(key) <= width],
+                           dtype=self.movie_ids.dtype)
+        positions = numpy.minimum(numpy.searchsorted(self.movie_ids, keys), len(self.movie_ids) - 1)
+        positions = numpy.unique(positions[self.movie_ids[positions] == keys])
+
+        result = set()
+        for position in positions:
+            start, end = self.offsets[position], self.offsets[position + 1]
+            selected = self.neighbours[start:end][self.scores[start:end] >= threshold]
+            result.update(movie_id.decode() for movie_id in self.movie_ids[selected].tolist())
+        return result
+
+    @classmethod
+    def _remove_old_versions(cls, path):
+        versions = sorted(entry for entry in os.listdir(path)
+                          if os.path.isdir(os.path.join(path, entry)) and not os.path.islink(os.path.join(path, entry)))
+        for version in versions[:-cls.KEPT_VERSIONS]:
+            shutil.rmtree(os.path.join(path, version), ignore_errors=True)
@@ -0,0 +1,61 @@
+from recommedation_algo import config
+from recommedation_algo.database import DatabaseHandler
+from unittest import mock
+
+import unittest
+
+
+class FakeCursor:
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def execute(self, query, variables=None):
+        self.queries.append((query, variables))
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+
+    def __init__(self, cursor):
+        self.dict_cursor = cursor
+
+    def cursor(self, cursor_factory=None):
+        return self.dict_cursor
+
+    def commit(self):
+        pass
+
+
+class TestDatabaseHandler(unittest.TestCase):
+
+    def connect(self, rows):
+        cursor = FakeCursor(rows)
+        with mock.patch.object(config, 'database_connection', return_value=(cursor, FakeConnection(cursor)),
+                               create=True):
+            return DatabaseHandler(), cursor
+
+    def test_get_neighbours_by_ids(self):
+        db, cursor = self.connect([('tt2', ), ('tt3', )])
+
+        self.assertEqual(db.get_neighbours_by_ids(['tt1', 'tt4'], 0.5), {'tt2', 'tt3'})
+        query, variables = cursor.queries[0]
+        self.assertEqual(variables, (['tt1', 'tt4'], 0.5))
+        self.assertIn("SELECT DISTINCT n.neighbour_id", query)
+
+    def test_get_ranked_neighbours_by_ids(self):
+        rows = [('tt2', 0.9, 1.6), ('tt3', 0.9, 0.9), ('tt5', 0.7, 1.3)]
+        db, cursor = self.connect(rows)
+
+        self.assertEqual(db.get_ranked_neighbours_by_ids(['tt1', 'tt4']), rows)
+        query, variables = cursor.queries[0]
+        self.assertEqual(variables, (['tt1', 'tt4'], 0.4))
+        self.assertIn("max(n.score), sum(n.score)", query)
+        self.assertIn("GROUP BY n.neighbour_id ORDER BY 2 DESC, 3 DESC", query)
+
+
+if __name__ == '__main__':
+    unittest.main()
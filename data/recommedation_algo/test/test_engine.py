@@ -0,0 +1,59 @@
+from recommedation_algo.engine import SimilarityEngine
+
+import unittest
+
+
+class TestSimilarityEngine(unittest.TestCase):
+
+    weights = {'genre': 0.3, 'actors': 0.3, 'director': 0.3}
+
+    history = [
+        {'movie_id': 'tt0000001', 'genre': 'Drama, Romance', 'actors': 'Ann, Bob, Cid',
+         'director': 'Dee', 'runtime': '120'},
+        {'movie_id': 'tt0000002', 'genre': 'Comedy', 'actors': 'Eve',
+         'director': 'Fay, Gus', 'runtime': '95'}
+    ]
+
+    movies = [
+        {'movie_id': 'tt0000001', 'genre': 'Drama, Romance', 'actors': 'Ann, Bob, Cid',
+         'director': 'Dee', 'runtime': '120'},
+        {'movie_id': 'tt0000003', 'genre': 'Drama', 'actors': 'Bob, Hal',
+         'director': 'Gus', 'runtime': '100'},
+        {'movie_id': 'tt0000004', 'genre': 'Horror, Comedy, Drama', 'actors': 'Ivy',
+         'director': 'Jon', 'runtime': '300'}
+    ]
+
+    @staticmethod
+    def reference_similarity(first, second):
+        """same formula as MovieSimilarity._calculate_similarity"""
+
+        def dice(first_value, second_value):
+            targets = [token.strip() for token in first_value.split(",")]
+            sources = [token.strip() for token in second_value.split(",")]
+            return len(set(sources).intersection(targets)) / ((len(targets) + len(sources)) / 2)
+
+        runtime = 1 - abs(int(first['runtime']) - int(second['runtime'])) / int(second['runtime'])
+        return 0.3 * (dice(first['genre'], second['genre']) + dice(first['actors'], second['actors']) +
+                      dice(first['director'], second['director'])) + 0.1 * runtime
+
+    def test_score_matches_reference(self):
+        engine = SimilarityEngine(self.weights, 0.1)
+        history = engine.encode(self.history)
+        movies = engine.encode(self.movies)
+        scores = engine.score(history, movies)
+
+        for row, first in enumerate(self.history):
+            for column, second in enumerate(self.movies):
+                self.assertAlmostEqual(scores[row][column], self.reference_similarity(first, second))
+
+    def test_score_blocks(self):
+        engine = SimilarityEngine(self.weights, 0.1)
+        history = engine.encode(self.history)
+        movies = engine.encode(self.movies)
+        full = engine.score(history, movies)
+
+        offsets = []
+        for offset, block in engine.score_blocks(history, movies, 1):
+            offsets.append(offset)
+            self.assertEqual(block.tolist(), full[offset:offset + 1].tolist())
+        self.assertEqual(offsets, [0, 1])
@@ -0,0 +1,33 @@
+from recommedation_algo.features import FeatureExtractor
+
+import unittest
+
+
+class TestFeatureExtractor(unittest.TestCase):
+
+    rows = [
+        {'movie_id': 'tt1', 'genre': 'Drama, Romance', 'actors': 'Ann, Bob, Ann', 'director': 'Dee', 'runtime': '120'},
+        {'movie_id': 'tt2', 'genre': 'Romance', 'actors': 'Bob', 'director': 'Dee, Eve', 'runtime': '95'}
+    ]
+
+    def test_extract(self):
+        extractor = FeatureExtractor()
+        first, second = extractor.extract(self.rows)
+
+        self.assertEqual(first.movie_id, 'tt1')
+        self.assertEqual(first.runtime, 120)
+        self.assertEqual(len(first.actors), 2)
+        self.assertEqual(first.actors_size, 3)
+        self.assertEqual(first.genre & second.genre, frozenset([extractor.vocabularies['genre']['Romance']]))
+        self.assertEqual(first.director & second.director, frozenset([extractor.vocabularies['director']['Dee']]))
+        self.assertRaises(AttributeError, setattr, first, 'title', 'no such slot')
+
+    def test_rows_parsed_once(self):
+        extractor = FeatureExtractor()
+        first = extractor.extract(self.rows)[0]
+        self.assertIs(extractor.extract(self.rows[:1])[0], first)
+
+        extractor.clear()
+        again = extractor.extract(self.rows[:1])[0]
+        self.assertIsNot(again, first)
+        self.assertEqual(again.genre, first.genre)
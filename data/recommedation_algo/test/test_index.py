@@ -0,0 +1,51 @@
+from recommedation_algo.engine import SimilarityEngine
+from recommedation_algo.index import InvertedIndex
+
+import random
+import unittest
+
+
+class TestInvertedIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = SimilarityEngine({'genre': 0.3, 'actors': 0.3, 'director': 0.3}, 0.1)
+
+        generator = random.Random(0)
+
+        def movie(index):
+            return {
+                'movie_id': 'tt' + str(index).zfill(7),
+                'genre': ", ".join(generator.sample(['Drama', 'Comedy', 'Horror', 'Action', 'Romance'], 2)),
+                'actors': ", ".join(generator.sample(['A' + str(i) for i in range(30)], 3)),
+                'director': 'D' + str(generator.randrange(10)),
+                'runtime': str(generator.randrange(80, 180))
+            }
+
+        self.movies = self.engine.encode([movie(index) for index in range(200)])
+        self.history = self.engine.encode([movie(index) for index in range(200, 220)])
+        self.index = InvertedIndex(self.engine, self.movies)
+
+    def test_candidates_cover_pairs_above_min_score(self):
+        scores = self.engine.score(self.history, self.movies)
+
+        for min_score in (0.4, 0.5, 0.7):
+            for start in (0, 8):
+                rows, candidates = self.index.candidate_pairs(self.history, start, len(self.history), min_score)
+                self.assertEqual(rows.tolist(), sorted(rows.tolist()))
+                pairs = set(zip(rows.tolist(), candidates.tolist()))
+                expected = set(zip(*(scores[start:] >= min_score).nonzero()))
+                self.assertTrue(set((start + row, column) for row, column in expected) <= pairs)
+                self.assertLess(len(pairs), (len(self.history) - start) * len(self.movies))
+
+    def test_required_features(self):
+        self.assertIsNone(self.index.required_features(0.1))
+        self.assertEqual(sorted(self.index.required_features(0.4)), ['actors', 'director', 'genre'])
+        self.assertEqual(sorted(self.index.required_features(0.5)), ['actors', 'director'])
+
+    def test_prunes(self):
+        self.assertFalse(self.index.prunes(0.1))
+        self.assertFalse(self.index.prunes(0.5))  # actors and directors are too common in this pool
+
+        self.index.DENSE_FRACTION = 0.5
+        self.assertFalse(self.index.prunes(0.4))  # sharing a genre is enough
+        self.assertTrue(self.index.prunes(0.5))
@@ -0,0 +1,168 @@
+from recommedation_algo.listener import RecommendationListener
+from recommedation_algo.recommender import Recommender
+from recommedation_algo.refresh import RefreshRequests
+from recommedation_algo.test.test_recommender import InMemoryDatabaseHandler, generate_ratings
+from unittest import mock
+
+import psycopg2
+import unittest
+
+
+class FakeClock:
+    """
+        stands in for the time module of the listener, sleeping advances the clock
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.closed = 0
+
+    def rollback(self):
+        if self.closed:
+            raise psycopg2.InterfaceError("connection already closed")
+
+
+class FakeListeningDatabase:
+    """
+        listening connection delivering the batches of notifications one
+        every interval seconds
+    """
+
+    def __init__(self, clock, batches=(), interval=1.0):
+        self.clock = clock
+        self.batches = list(batches)
+        self.interval = interval
+        self.conn = FakeConnection()
+        self.channels = []
+
+    def create_notify_triggers(self):
+        pass
+
+    def listen(self, channels):
+        self.channels.extend(channels)
+
+    def wait_for_notifications(self, timeout):
+        if self.conn.closed:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        if self.batches and self.interval <= timeout:
+            self.clock.sleep(self.interval)
+            return self.batches.pop(0)
+        self.clock.sleep(timeout)
+        return []
+
+
+class TestRecommendationListener(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('recommedation_algo.listener.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.recommender = Recommender(refresh_queue=RefreshRequests(), db=self.connected_database())
+        self.recommender.update_user_recommendations = mock.Mock()
+
+    @staticmethod
+    def connected_database():
+        db = InMemoryDatabaseHandler(*generate_ratings())
+        db.conn = FakeConnection()
+        return db
+
+    def listener(self, db, db_factory=None):
+        listener = RecommendationListener(self.recommender, db, db_factory)
+        listener.listening = True
+        listener.last_sweep = self.clock.now
+        return listener
+
+    def test_collect_until_debounced(self):
+        batches = [[('public_ratings', 'tt000000' + str(index))] for index in range(3)]
+        listener = self.listener(FakeListeningDatabase(self.clock, batches))
+
+        self.assertEqual(listener.collect(), [notification for batch in batches for notification in batch])
+        self.assertEqual(self.clock.now, 3 + listener.DEBOUNCE)
+
+    def test_collect_until_max_delay(self):
+        batches = [[('public_ratings', 'tt' + str(index).zfill(7))] for index in range(100)]
+        listener = self.listener(FakeListeningDatabase(self.clock, batches))
+
+        self.assertEqual(len(listener.collect()), listener.MAX_DELAY)
+        self.assertEqual(self.clock.now, listener.MAX_DELAY)
+
+    def test_handle_rating_changes(self):
+        listener = self.listener(FakeListeningDatabase(self.clock))
+        keys = ['user_id', 'movie_id', 'score', 'old_score', 'operation', 'version']
+        changes = [dict(zip(keys, values)) for values in [(1, 'tt0000001', 7.0, None, 'INSERT', 1),
+                                                           (1, 'tt0000001', 5.0, 7.0, 'UPDATE', 2),
+                                                           (2, 'tt0000002', None, 6.0, 'DELETE', 1)]]
+
+        with mock.patch('recommedation_algo.listener.UserScale') as scale:
+            listener.handle([('user_ratings', change) for change in changes])
+
+        self.assertEqual(scale.call_args_list, [
+            mock.call(change['user_id'], self.recommender.db,
+                      (change['movie_id'], change['score'], change['old_score'], change['version']))
+            for change in changes
+        ])
+        self.assertEqual(set(self.recommender.update_user_recommendations.call_args[0][0]), {1, 2})
+
+    def test_handle_public_rating_changes(self):
+        listener = self.listener(FakeListeningDatabase(self.clock))
+        db = self.recommender.db
+        seed = next(movie_id for movie_id, score in db.user_ratings[1].items()
+                    if score >= self.recommender.USER_RATINGS_CRITERION and db.neighbour_lists.get(movie_id, ([], ))[0])
+        movie_id = db.neighbour_lists[seed][0][0]
+        expected = set(user_id for user_id, ratings in db.user_ratings.items()
+                       if any(score >= self.recommender.USER_RATINGS_CRITERION and
+                              movie_id in db.neighbour_lists.get(seed_id, ([], ))[0]
+                              for seed_id, score in ratings.items()))
+
+        listener.handle([('public_ratings', movie_id)])
+
+        self.assertIn(1, expected)
+        self.assertEqual(set(self.recommender.update_user_recommendations.call_args[0][0]), expected)
+
+    def test_reconnect_after_losing_connections(self):
+        lost = FakeListeningDatabase(self.clock)
+        reconnected = FakeListeningDatabase(self.clock)
+        recommender_db = self.connected_database()
+        listener = self.listener(lost, lambda metrics=None: recommender_db if metrics else reconnected)
+
+        lost.conn.closed = 2
+        self.recommender.db.conn.closed = 2
+        self.recommender.update_user_recommendations.side_effect = KeyboardInterrupt  # stops the loop
+        with self.assertRaises(KeyboardInterrupt):
+            listener.run()
+
+        self.assertIs(self.recommender.db, recommender_db)
+        self.assertIs(listener.db, reconnected)
+        self.assertEqual(reconnected.channels, listener.CHANNELS)
+        self.assertEqual(self.clock.sleeps, [listener.BACKOFF])
+        self.recommender.update_user_recommendations.assert_called_once_with()  # sweep for the lost notifications
+
+    def test_back_off_while_failing(self):
+        db = FakeListeningDatabase(self.clock)
+        db.wait_for_notifications = mock.Mock(side_effect=psycopg2.OperationalError("canceling statement"))
+        listener = self.listener(db)
+
+        with mock.patch.object(listener, 'recover', side_effect=[None] * 7 + [KeyboardInterrupt]):
+            with self.assertRaises(KeyboardInterrupt):
+                listener.run()
+
+        self.assertEqual(self.clock.sleeps, [1, 2, 4, 8, 16, 32, 60, 60])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+from recommedation_algo.engine import SimilarityEngine
+from recommedation_algo.lsh import MinHashLSH
+
+import numpy
+import unittest
+
+
+class TestMinHashLSH(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = SimilarityEngine({'genre': 0.3, 'actors': 0.3, 'director': 0.3}, 0.1)
+        self.movies = self.engine.encode([
+            {'movie_id': 'tt1', 'genre': 'Drama', 'actors': 'Ann, Bob, Cid', 'director': 'Dee', 'runtime': '100'},
+            {'movie_id': 'tt2', 'genre': 'Drama', 'actors': 'Ann, Bob, Cid', 'director': 'Dee', 'runtime': '110'},
+            {'movie_id': 'tt3', 'genre': 'Horror', 'actors': 'Eve, Fay', 'director': 'Gus', 'runtime': '90'},
+            {'movie_id': 'tt4', 'genre': 'Comedy', 'actors': 'Hal, Ivy', 'director': 'Jon', 'runtime': '95'}
+        ])
+
+    def test_identical_sets_collide(self):
+        lsh = MinHashLSH(permutations=64, bands=16)
+        signatures = lsh.signatures(self.engine, self.movies, chunk_size=3)
+        self.assertEqual(signatures[0].tolist(), signatures[1].tolist())
+
+        firsts, seconds = lsh.candidate_pairs(signatures)
+        pairs = set(zip(firsts.tolist(), seconds.tolist()))
+        self.assertIn((0, 1), pairs)
+        self.assertNotIn((2, 3), pairs)
+
+    def test_score_pairs_matches_score(self):
+        full = self.engine.score(self.movies, self.movies)
+        left = numpy.array([0, 1, 2, 3])
+        right = numpy.array([1, 0, 3, 3])
+        paired = self.engine.score_pairs(self.movies, self.movies, left, right)
+        self.assertTrue(numpy.allclose(paired, full[left, right]))
+
+    def test_bands_must_divide_permutations(self):
+        self.assertRaises(ValueError, MinHashLSH, 100, 32)
@@ -0,0 +1,65 @@
+from recommedation_algo.metrics import CountingCursor, PipelineMetrics
+
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+
+class FakeCursor:
+
+    def __init__(self):
+        self.queries = []
+
+    def execute(self, query, variables=None):
+        self.queries.append(query)
+
+    def fetchall(self):
+        return [(len(self.queries), )]
+
+
+class TestPipelineMetrics(unittest.TestCase):
+
+    def test_values_are_attributed_to_the_current_user(self):
+        metrics = PipelineMetrics()
+        with metrics.user(1):
+            with metrics.stage('seeds'):
+                metrics.increment('statements', 2)
+        with metrics.user(2):
+            metrics.increment('statements')
+
+        thread = threading.Thread(target=metrics.increment, args=('refreshes', ))
+        with metrics.user(2):
+            thread.start()
+            thread.join()
+
+        summary = metrics.summary()
+        self.assertEqual(summary['users'], 2)
+        self.assertEqual(summary['totals']['statements'], 3)
+        self.assertEqual(summary['totals']['refreshes'], 1)
+        self.assertEqual(summary['per_user_mean']['statements'], 1.5)
+        self.assertIn('seeds_seconds', metrics.users[1])
+        self.assertEqual(metrics.users[2], {'statements': 1})
+
+    def test_merge_and_write(self):
+        metrics = PipelineMetrics()
+        metrics.merge({3: {'statements': 4}}, {'statements': 4, 'refreshes': 1})
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metrics.json')
+            metrics.write(path)
+            with open(path) as metrics_file:
+                content = json.load(metrics_file)
+
+        self.assertEqual(content['users'], {'3': {'statements': 4}})
+        self.assertEqual(content['summary']['totals'], {'statements': 4, 'refreshes': 1})
+
+    def test_counting_cursor(self):
+        metrics = PipelineMetrics()
+        cursor = CountingCursor(FakeCursor(), metrics)
+        cursor.execute("SELECT 1")
+        cursor.execute("SELECT 2")
+
+        self.assertEqual(cursor.fetchall(), [(2, )])
+        self.assertEqual(metrics.totals['statements'], 2)
@@ -0,0 +1,33 @@
+from recommedation_algo.neighbours import TopKNeighbours
+
+import numpy
+import unittest
+
+
+class TestTopKNeighbours(unittest.TestCase):
+
+    class StoredLists:
+
+        def __init__(self, stored):
+            self.stored = stored
+            self.saved = None
+
+        def get_neighbour_lists(self, movie_ids):
+            return {movie_id: self.stored[movie_id] for movie_id in movie_ids if movie_id in self.stored}
+
+        def save_neighbour_lists(self, rows):
+            self.saved = rows
+
+    def test_keeps_k_best(self):
+        neighbours = TopKNeighbours(None, 2)
+        neighbours.add_many('tt1', ['tt2', 'tt3', 'tt4', 'tt5'], numpy.array([0.2, 0.9, 0.5, 0.1]))
+        neighbours.add('tt1', 'tt6', 0.7)
+        self.assertEqual(neighbours.get_neighbours('tt1'), [('tt3', 0.9), ('tt6', 0.7)])
+
+    def test_flush_merges_stored_lists(self):
+        db = self.StoredLists({'tt1': (['tt2', 'tt3'], [0.8, 0.6])})
+        neighbours = TopKNeighbours(db, 2, merge=True)
+        neighbours.add('tt1', 'tt3', 0.7)
+        neighbours.add('tt1', 'tt4', 0.5)
+        neighbours.flush()
+        self.assertEqual(db.saved, [('tt1', ['tt2', 'tt3'], [0.8, 0.7])])
@@ -0,0 +1,476 @@
+from recommedation_algo.batch import BatchRecommender
+from recommedation_algo.recommender import Recommender
+from recommedation_algo.refresh import RefreshRequests
+from recommedation_algo.similarity import MovieSimilarity
+from recommedation_algo.store import NeighbourStore
+from datetime import datetime
+from unittest import mock
+
+import numpy
+import os
+import signal
+import tempfile
+import time
+import unittest
+
+
+class InMemoryDatabaseHandler:
+    """
+        stand-in for DatabaseHandler with the methods used by the
+        recommenders, storing ratings, models and recommendations in
+        dictionaries
+    """
+
+    def __init__(self, user_ratings, public_ratings, neighbour_lists):
+        """
+        :param user_ratings: dictionary, user id -> {movie id: score}
+        :param public_ratings: dictionary, movie id -> [IMDb, Douban, Trakt] score, None if missing
+        :param neighbour_lists: dictionary, movie id -> (neighbour ids, scores)
+        """
+        self.user_ratings = user_ratings
+        self.public_ratings = public_ratings
+        self.neighbour_lists = neighbour_lists
+        self.updated_at = datetime.now()
+        self.clock = 0  # stands in for the database clock, ticking at every read
+        self.neighbours_updated_at = {movie_id: self.get_timestamp() for movie_id in neighbour_lists}
+        self.neighbours_published_at = {}
+        self.rating_versions = {}
+        self.scale_statistics = {}
+        self.recommendations = {}
+        self.recommendation_state = {}
+        self.calls = {}
+
+    def count(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+    def rate(self, user_id, movie_id, score):
+        """
+        add, update or remove, if score is None, a rating as the backend
+        does, the notify trigger bumps the rating version
+        :return: integer, the new rating version of the user
+        """
+        if score is None:
+            del self.user_ratings[user_id][movie_id]
+        else:
+            self.user_ratings.setdefault(user_id, {})[movie_id] = score
+        self.rating_versions[user_id] = self.rating_versions.get(user_id, 0) + 1
+        return self.rating_versions[user_id]
+
+    def set_public_scores(self, movie_id, scores):
+        """
+        update the public ratings of a movie, bumping the rating versions of the users who rated it
+        """
+        self.public_ratings[movie_id] = scores
+        for user_id, ratings in self.user_ratings.items():
+            if movie_id in ratings:
+                self.rating_versions[user_id] = self.rating_versions.get(user_id, 0) + 1
+
+    def create_tables(self):
+        pass
+
+    def set_statement_timeout(self, seconds):
+        pass
+
+    def get_timestamp(self):
+        self.clock += 1
+        return self.clock
+
+    def get_users(self):
+        return [{'id': user_id} for user_id in self.user_ratings]
+
+    def get_user_history(self, user_id):
+        self.count('get_user_history')
+        return [(movie_id, score) for movie_id, score in self.user_ratings[user_id].items()
+                if movie_id in self.public_ratings]
+
+    def get_all_user_history(self):
+        return [(user_id, movie_id, score) for user_id in self.user_ratings
+                for movie_id, score in self.get_user_history(user_id)]
+
+    def get_public_rating_vectors(self, movie_ids):
+        self.count('get_public_rating_vectors')
+        vectors = {}
+        for movie_id in movie_ids:
+            scores = self.public_ratings.get(movie_id)
+            if scores is not None:
+                vectors[movie_id] = {'scores': list(scores),
+                                     'count': len([score for score in scores if score is not None]),
+                                     'updated_at': self.updated_at}
+        return vectors
+
+    def get_scale_training_data(self, user_ids):
+        self.count('get_scale_training_data')
+        rows = [(user_id, *self.public_ratings[movie_id], score) for user_id in sorted(user_ids)
+                for movie_id, score in self.user_ratings[user_id].items()
+                if None not in self.public_ratings.get(movie_id, [None])]
+        rows = numpy.array(rows, dtype=numpy.float64).reshape(-1, 5)
+        return rows[:, 0].astype(numpy.int64), rows[:, 1:4], rows[:, 4]
+
+    def get_rating_version(self, user_id):
+        self.count('get_rating_version')
+        return self.rating_versions.get(user_id, 0)
+
+    def get_scale_statistics(self, user_id):
+        return self.scale_statistics.get(user_id)
+
+    def save_scale_statistics(self, user_id, gram, moments, version):
+        self.count('save_scale_statistics')
+        self.scale_statistics[user_id] = {'gram': gram, 'moments': moments, 'version': version}
+
+    def get_dirty_users(self, seed_criterion, user_ids=None, published=False):
+        changed_at = self.neighbours_published_at if published else self.neighbours_updated_at
+        states = []
+        for user_id in self.user_ratings if user_ids is None else user_ids:
+            fingerprint = str(sorted(self.user_ratings[user_id].items()))
+            state = self.recommendation_state.get(user_id)
+            if state is None or state[0] != fingerprint or any(
+                    changed_at.get(movie_id, 0) > state[1]
+                    for movie_id, score in self.user_ratings[user_id].items() if score >= seed_criterion):
+                states.append((user_id, fingerprint, self.get_timestamp()))
+        return states
+
+    def save_recommendation_state(self, states):
+        for user_id, fingerprint, computed_at in states:
+            self.recommendation_state[user_id] = (fingerprint, computed_at)
+
+    def get_users_by_candidate_movies(self, movie_ids, seed_criterion):
+        return set(user_id for user_id, ratings in self.user_ratings.items() for movie_id, score in ratings.items()
+                   if score >= seed_criterion and set(movie_ids) & set(self.neighbour_lists.get(movie_id, ([], ))[0]))
+
+    def get_neighbours_by_ids(self, movie_ids, threshold=0.4):
+        return set(neighbour_id for movie_id in movie_ids
+                   for neighbour_id, score in zip(*self.neighbour_lists.get(movie_id, ([], [])))
+                   if score >= threshold)
+
+    def get_neighbour_lists(self, movie_ids):
+        return {movie_id: self.neighbour_lists[movie_id] for movie_id in movie_ids if movie_id in self.neighbour_lists}
+
+    def get_all_neighbour_lists(self):
+        return dict(self.neighbour_lists)
+
+    def save_neighbour_lists(self, neighbour_lists):
+        updated_at = self.get_timestamp()
+        for movie_id, neighbour_ids, scores in neighbour_lists:
+            self.neighbour_lists[movie_id] = (neighbour_ids, scores)
+            self.neighbours_updated_at[movie_id] = updated_at
+
+    def mark_neighbour_lists_published(self, exported_at):
+        published_at = self.get_timestamp()
+        for movie_id, updated_at in self.neighbours_updated_at.items():
+            if updated_at <= exported_at and self.neighbours_published_at.get(movie_id, 0) < updated_at:
+                self.neighbours_published_at[movie_id] = published_at
+
+    def get_10_popular_movies(self):
+        self.count('get_10_popular_movies')
+        return [(movie_id, scores[0]) for movie_id, scores in sorted(self.public_ratings.items())[:10]]
+
+    def save_recommendations(self, recommendations, user_id):
+        self.save_all_recommendations([(user_id, movie_id, score) for movie_id, score in recommendations], [user_id])
+
+    def save_all_recommendations(self, recommendations, user_ids):
+        for user_id in user_ids:
+            self.recommendations[user_id] = {}
+        for user_id, movie_id, score in recommendations:
+            self.recommendations[user_id][movie_id] = score
+
+
+class InMemoryDatabaseFactory:
+    """
+        db factory of the worker processes, which get a copy of the database
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __call__(self, metrics=None):
+        return self.db
+
+
+class HangingDatabaseHandler(InMemoryDatabaseHandler):
+    """
+        in-memory handler stuck on the history of one user, where the user timeout cannot interrupt it
+    """
+
+    def __init__(self, hanging_user, *args):
+        super().__init__(*args)
+        self.hanging_user = hanging_user
+
+    def get_user_history(self, user_id):
+        if user_id == self.hanging_user:
+            signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGALRM])
+            time.sleep(3600)
+        return super().get_user_history(user_id)
+
+
+def generate_ratings(user_count=12, movie_count=80, seed=0):
+    """
+    synthetic users, public ratings and neighbour lists; some movies
+    miss a rating source, and the last user rated too few movies for
+    their scale to be fitted
+    :return: arguments of InMemoryDatabaseHandler
+    """
+    generator = numpy.random.RandomState(seed)
+    movie_ids = ['tt' + str(index).zfill(7) for index in range(movie_count)]
+
+    public_ratings = {}
+    for movie_id in movie_ids:
+        scores = generator.uniform(3, 10, 3).round(1).tolist()
+        if generator.rand() < 0.1:
+            scores[generator.randint(3)] = None
+        public_ratings[movie_id] = scores
+
+    neighbour_lists = {}
+    for movie_id in movie_ids:
+        neighbour_ids = generator.choice(movie_ids, 10, replace=False).tolist()
+        neighbour_lists[movie_id] = (neighbour_ids, generator.uniform(0.2, 1, 10).round(3).tolist())
+
+    user_ratings = {}
+    for user_id in range(1, user_count):
+        rated = generator.choice(movie_ids, 20, replace=False)
+        user_ratings[user_id] = {movie_id: float(generator.randint(2, 11)) for movie_id in rated}
+    user_ratings[user_count] = {movie_id: 9.0 for movie_id in generator.choice(movie_ids, 3, replace=False)}
+    return user_ratings, public_ratings, neighbour_lists
+
+
+class TestBatchRecommender(unittest.TestCase):
+
+    def test_same_recommendations_as_recommender(self):
+        ratings = generate_ratings()
+        single_db = InMemoryDatabaseHandler(*ratings)
+        batch_db = InMemoryDatabaseHandler(*ratings)
+
+        Recommender(refresh_queue=RefreshRequests(), db=single_db).update_user_recommendations()
+        BatchRecommender(refresh_queue=RefreshRequests(), db=batch_db).update_user_recommendations()
+
+        self.assertEqual(set(single_db.recommendations), set(ratings[0]))
+        self.assertTrue(any(single_db.recommendations.values()))
+        for user_id, recommendations in single_db.recommendations.items():
+            self.assertEqual(set(batch_db.recommendations[user_id]), set(recommendations))
+            for movie_id, score in recommendations.items():
+                self.assertAlmostEqual(batch_db.recommendations[user_id][movie_id], score)
+
+    def test_limit(self):
+        ratings = generate_ratings()
+        single_db = InMemoryDatabaseHandler(*ratings)
+        batch_db = InMemoryDatabaseHandler(*ratings)
+
+        Recommender(refresh_queue=RefreshRequests(), limit=3, db=single_db).update_user_recommendations()
+        BatchRecommender(refresh_queue=RefreshRequests(), limit=3, db=batch_db).update_user_recommendations()
+
+        for user_id, recommendations in single_db.recommendations.items():
+            self.assertLessEqual(len(recommendations), 3)
+            self.assertEqual(sorted(batch_db.recommendations[user_id]), sorted(recommendations))
+
+    def test_unchanged_users_are_skipped(self):
+        ratings = generate_ratings()
+        db = InMemoryDatabaseHandler(*ratings)
+        recommender = BatchRecommender(refresh_queue=RefreshRequests(), db=db)
+        recommender.update_user_recommendations()
+
+        db.rate(1, 'tt0000000', 9.0)
+        db.recommendations.clear()
+        recommender.update_user_recommendations()
+        self.assertEqual(list(db.recommendations), [1])
+
+
+class TestParallelRecommender(unittest.TestCase):
+
+    def test_workers_store_the_same_recommendations(self):
+        ratings = generate_ratings()
+        single_db = InMemoryDatabaseHandler(*ratings)
+        parallel_db = InMemoryDatabaseHandler(*ratings)
+
+        Recommender(refresh_queue=RefreshRequests(), db=single_db).update_user_recommendations()
+        recommender = Recommender(refresh_queue=RefreshRequests(), workers=2, db=parallel_db,
+                                  db_factory=InMemoryDatabaseFactory(parallel_db))
+        recommender.USER_CHUNK_SIZE = 3
+        recommender.update_user_recommendations()
+
+        self.assertEqual(set(parallel_db.recommendations), set(single_db.recommendations))
+        for user_id, recommendations in single_db.recommendations.items():
+            self.assertEqual(set(parallel_db.recommendations[user_id]), set(recommendations))
+            for movie_id, score in recommendations.items():
+                self.assertAlmostEqual(parallel_db.recommendations[user_id][movie_id], score)
+        self.assertEqual(set(parallel_db.recommendation_state), set(ratings[0]))
+
+    def test_stuck_workers_are_terminated(self):
+        db = HangingDatabaseHandler(1, *generate_ratings())
+        recommender = Recommender(refresh_queue=RefreshRequests(), workers=2, db=db,
+                                  db_factory=InMemoryDatabaseFactory(db))
+        recommender.USER_CHUNK_SIZE = 3
+        recommender.CHUNK_TIMEOUT = 2
+
+        started = time.time()
+        recommender.update_user_recommendations()
+
+        self.assertLess(time.time() - started, 30)
+        self.assertEqual(set(db.recommendations), set(db.user_ratings) - {1, 2, 3})  # the chunk of user 1 is left dirty
+        self.assertEqual(set(db.recommendation_state), set(db.recommendations))
+
+
+class TestRecommendForUser(unittest.TestCase):
+
+    def setUp(self):
+        self.db = InMemoryDatabaseHandler(*generate_ratings())
+        self.recommender = Recommender(refresh_queue=RefreshRequests(), db=self.db)
+
+    def expire_caches(self):
+        expired = self.recommender.RATING_CACHE_TTL + 1
+        self.recommender.rating_cache = {movie_id: (loaded_at - expired, ratings) for movie_id, (loaded_at, ratings)
+                                         in self.recommender.rating_cache.items()}
+        if self.recommender.popular_movies is not None:
+            loaded_at, popular = self.recommender.popular_movies
+            self.recommender.popular_movies = (loaded_at - expired, popular)
+
+    def test_same_recommendations_as_stored(self):
+        self.recommender.update_user_recommendations()
+
+        for user_id, stored in self.db.recommendations.items():
+            recommendations = self.recommender.recommend_for_user(user_id)
+            self.assertEqual([movie_id for movie_id, _ in recommendations],
+                             sorted(stored, key=stored.get, reverse=True))
+            for movie_id, score in recommendations:
+                self.assertAlmostEqual(score, stored[movie_id])
+
+        self.assertEqual(self.recommender.recommend_for_user(1, limit=2), self.recommender.recommend_for_user(1)[:2])
+
+    def test_cold_start(self):
+        self.db.user_ratings[99] = {'tt0000001': 4.0, 'tt0000002': 5.0}
+        popular = [[movie_id, score] for movie_id, score in self.db.get_10_popular_movies()]
+
+        self.assertEqual(self.recommender.recommend_for_user(99), popular)
+        self.assertEqual(self.recommender.recommend_for_user(99, limit=3), popular[:3])
+        self.assertEqual(self.db.calls['get_10_popular_movies'], 2)
+
+        self.expire_caches()
+        self.assertEqual(self.recommender.recommend_for_user(99), popular)
+        self.assertEqual(self.db.calls['get_10_popular_movies'], 3)
+
+    def test_rating_cache(self):
+        recommendations = self.recommender.recommend_for_user(1)
+        self.assertEqual(self.db.calls['get_public_rating_vectors'], 1)
+
+        for movie_id in self.db.public_ratings:  # the training set of the scale is left unchanged
+            if movie_id not in self.db.user_ratings[1]:
+                self.db.set_public_scores(movie_id, [10.0, 10.0, 10.0])
+        self.assertEqual(self.recommender.recommend_for_user(1), recommendations)
+        self.assertEqual(self.db.calls['get_public_rating_vectors'], 1)
+
+        self.expire_caches()
+        self.assertNotEqual(self.recommender.recommend_for_user(1), recommendations)
+        self.assertEqual(self.db.calls['get_public_rating_vectors'], 2)
+
+    def test_scale_cache(self):
+        scale = self.recommender._get_cached_scale(1, 0)
+        self.assertIs(self.recommender._get_cached_scale(1, 0), scale)
+        self.assertEqual(self.db.calls['get_scale_training_data'], 1)
+
+        rebuilt = self.recommender._get_cached_scale(1, self.db.rate(1, 'tt0000000', 2.0))
+        self.assertIsNot(rebuilt, scale)
+        self.assertIs(self.recommender._get_cached_scale(1, self.db.get_rating_version(1)), rebuilt)
+
+        self.db.set_public_scores('tt0000000', [2.0, 3.0, 2.5])
+        refitted = self.recommender._get_cached_scale(1, self.db.get_rating_version(1))
+        self.assertIsNot(refitted, rebuilt)
+        self.assertEqual(self.db.calls['get_scale_training_data'], 3)
+        self.assertNotIn('save_scale_statistics', self.db.calls)  # the read path does not write
+
+        self.recommender.update_user_recommendations()  # stores the statistics
+        fits = self.db.calls['get_scale_training_data']
+        self.recommender.scale_cache.clear()
+        solved = self.recommender._get_cached_scale(1, self.db.get_rating_version(1))
+        self.assertTrue(numpy.allclose(solved.coefficients, refitted.coefficients))
+        self.assertEqual(self.db.calls['get_scale_training_data'], fits)
+
+    def test_warm_calls_within_latency_budget(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'store')
+            MovieSimilarity(self.db).publish_neighbour_store(path)
+            recommender = Recommender(NeighbourStore(path), refresh_queue=RefreshRequests(), db=self.db)
+
+            user_ids = list(self.db.user_ratings)
+            for user_id in user_ids:
+                recommender.recommend_for_user(user_id)
+            calls = dict(self.db.calls)
+
+            elapsed = []
+            for _ in range(20):
+                for user_id in user_ids:
+                    started = time.perf_counter()
+                    recommender.recommend_for_user(user_id)
+                    elapsed.append(time.perf_counter() - started)
+
+        # warm calls only read the rating version, a primary key lookup left out of the timings
+        calls['get_rating_version'] += len(elapsed)
+        self.assertEqual(self.db.calls, calls)
+        self.assertLess(numpy.percentile(elapsed, 95), recommender.LATENCY_BUDGET)
+
+
+class TestNeighbourStorePublication(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'store')
+        self.db = InMemoryDatabaseHandler(*generate_ratings())
+        self.similarity = MovieSimilarity(self.db)
+
+        # a seed of user 1, whose new neighbours are rated high by every source
+        self.seed = next(movie_id for movie_id, score in self.db.user_ratings[1].items() if score >= 8.0)
+        self.neighbour_ids = ['tt9000000', 'tt9000001']
+        for movie_id in self.neighbour_ids:
+            self.db.public_ratings[movie_id] = [9.5, 9.5, 9.5]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def update_neighbours(self, recommender):
+        recommender.update_user_recommendations()
+        self.db.recommendations.clear()
+        self.db.save_neighbour_lists([(self.seed, self.neighbour_ids, [0.9, 0.9])])
+
+    def test_users_are_recomputed_once_published(self):
+        self.similarity.publish_neighbour_store(self.path)
+        recommender = Recommender(NeighbourStore(self.path), refresh_queue=RefreshRequests(), db=self.db)
+        self.update_neighbours(recommender)
+
+        recommender.update_user_recommendations()  # the recommender still reads the previous version
+        self.assertEqual(self.db.recommendations, {})
+
+        self.similarity.publish_neighbour_store(self.path)
+        recommender.update_user_recommendations()
+        self.assertIn(1, self.db.recommendations)
+        self.assertTrue(set(self.neighbour_ids) <= set(self.db.recommendations[1]))
+
+        self.db.recommendations.clear()
+        self.similarity.publish_neighbour_store(self.path)
+        recommender.update_user_recommendations()
+        self.assertEqual(self.db.recommendations, {})
+
+    def test_users_checked_while_publishing_are_recomputed(self):
+        self.similarity.publish_neighbour_store(self.path)
+        recommender = Recommender(NeighbourStore(self.path), refresh_queue=RefreshRequests(), db=self.db)
+        self.update_neighbours(recommender)
+        publish = NeighbourStore.publish
+
+        def publish_after_update(neighbour_lists, path):
+            recommender.update_user_recommendations()  # after the export, before the new version is current
+            return publish(neighbour_lists, path)
+
+        with mock.patch.object(NeighbourStore, 'publish', side_effect=publish_after_update):
+            self.similarity.publish_neighbour_store(self.path)
+        self.assertEqual(self.db.recommendations, {})
+
+        recommender.update_user_recommendations()
+        self.assertTrue(set(self.neighbour_ids) <= set(self.db.recommendations[1]))
+
+    def test_users_are_recomputed_once_saved_without_store(self):
+        recommender = Recommender(refresh_queue=RefreshRequests(), db=self.db)
+        self.update_neighbours(recommender)
+
+        recommender.update_user_recommendations()
+        self.assertIn(1, self.db.recommendations)
+        self.assertTrue(set(self.neighbour_ids) <= set(self.db.recommendations[1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
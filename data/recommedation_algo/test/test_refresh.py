@@ -0,0 +1,56 @@
+from recommedation_algo.refresh import RefreshQueue, RefreshRequests
+
+import threading
+import unittest
+
+
+class FakeController:
+
+    def __init__(self, release, refreshed):
+        self.release = release
+        self.refreshed = refreshed
+
+    def update_single_movie_rating(self, movie_id):
+        self.release.wait()
+        if movie_id == 'tt0000000':
+            raise ValueError("website unavailable")
+        self.refreshed.append(movie_id)
+
+
+class TestRefreshQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.refreshed = []
+        self.queue = RefreshQueue(lambda: FakeController(self.release, self.refreshed), workers=2)
+
+    def tearDown(self):
+        self.release.set()
+        self.queue.shutdown()
+
+    def test_pending_movies_are_not_queued_twice(self):
+        self.assertEqual(self.queue.enqueue(['tt0000001', 'tt0000002', 'tt0000001']), 2)
+        self.assertEqual(self.queue.enqueue(['tt0000002', 'tt0000003']), 1)
+        self.assertEqual(len(self.queue), 3)
+
+        self.release.set()
+        self.queue.shutdown()
+        self.assertEqual(sorted(self.refreshed), ['tt0000001', 'tt0000002', 'tt0000003'])
+        self.assertEqual(len(self.queue), 0)
+
+    def test_failures_are_isolated(self):
+        self.queue.enqueue(['tt0000000', 'tt0000001'])
+        with self.assertLogs(level='ERROR'):
+            self.release.set()
+            self.queue.shutdown()
+        self.assertEqual(self.refreshed, ['tt0000001'])
+
+
+class TestRefreshRequests(unittest.TestCase):
+
+    def test_drain(self):
+        requests = RefreshRequests()
+        self.assertEqual(requests.enqueue(['tt0000001', 'tt0000002']), 2)
+        self.assertEqual(requests.enqueue(['tt0000002', 'tt0000003']), 1)
+        self.assertEqual(sorted(requests.drain()), ['tt0000001', 'tt0000002', 'tt0000003'])
+        self.assertEqual(requests.drain(), [])
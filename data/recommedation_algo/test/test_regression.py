@@ -0,0 +1,75 @@
+from recommedation_algo.regression import add_observation, batch_statistics, fit_batch_least_squares, \
+    predict_scores, solve_statistics
+
+import numpy
+import unittest
+
+
+def fit_least_squares(regressors, responses):
+    """
+    reference the batch fits are checked against: ordinary least squares
+    with an intercept, giving the same solution as sklearn's
+    LinearRegression, the minimum norm solution of the centered problem
+    :param regressors: numpy array of shape (n, features)
+    :param responses: numpy array of shape (n, )
+    :return: numpy array of coefficients, float intercept
+    """
+    regressor_mean = regressors.mean(axis=0)
+    response_mean = responses.mean()
+    coefficients = numpy.linalg.lstsq(regressors - regressor_mean, responses - response_mean, rcond=None)[0]
+    return coefficients, response_mean - regressor_mean.dot(coefficients)
+
+
+class TestRegression(unittest.TestCase):
+
+    def test_fit_least_squares(self):
+        generator = numpy.random.RandomState(0)
+        regressors = generator.uniform(1, 10, size=(20, 3))
+        responses = regressors.dot([0.5, 0.2, 0.1]) + 1.5
+
+        coefficients, intercept = fit_least_squares(regressors, responses)
+        self.assertTrue(numpy.allclose(coefficients, [0.5, 0.2, 0.1]))
+        self.assertAlmostEqual(intercept, 1.5)
+
+    def test_fit_single_sample(self):
+        coefficients, intercept = fit_least_squares(numpy.array([[7.0, 8.0, 6.0]]), numpy.array([9.0]))
+        self.assertEqual(coefficients.tolist(), [0, 0, 0])
+        self.assertEqual(intercept, 9.0)
+
+    def test_fit_batch_least_squares(self):
+        generator = numpy.random.RandomState(0)
+        regressors = generator.uniform(1, 10, size=(30, 3))
+        groups = numpy.repeat([0, 1, 2], 10)
+        responses = regressors.dot([0.5, 0.2, 0.1]) + generator.normal(size=30)
+        regressors[20:] = regressors[20:, :1]  # identical sources, rank deficient
+
+        coefficients, intercepts, fitted = fit_batch_least_squares(groups, regressors, responses, 4)
+        self.assertEqual(fitted.tolist(), [True, True, False, False])
+        for group in (0, 1):
+            expected = fit_least_squares(regressors[groups == group], responses[groups == group])
+            self.assertTrue(numpy.allclose(coefficients[group], expected[0]))
+            self.assertAlmostEqual(intercepts[group], expected[1])
+
+    def test_rank_one_updates(self):
+        generator = numpy.random.RandomState(1)
+        regressors = generator.uniform(1, 10, size=(12, 3))
+        responses = generator.uniform(1, 10, size=12)
+
+        gram, moments = batch_statistics(numpy.zeros(10, dtype=numpy.int64), regressors[:10], responses[:10], 1)
+        gram, moments = gram[0], moments[0]
+        for row in (10, 11):
+            add_observation(gram, moments, regressors[row], responses[row])
+        add_observation(gram, moments, regressors[3], responses[3], weight=-1)
+
+        kept = numpy.arange(12) != 3
+        coefficients, intercepts, fitted = solve_statistics(gram[None], moments[None])
+        expected = fit_least_squares(regressors[kept], responses[kept])
+        self.assertTrue(fitted[0])
+        self.assertTrue(numpy.allclose(coefficients[0], expected[0]))
+        self.assertAlmostEqual(intercepts[0], expected[1])
+
+    def test_predict_scores(self):
+        regressors = numpy.array([[6.0, 7.0, 8.0], [6.0, 7.0, 8.0]])
+        coefficients = numpy.array([[1.0, 0.0, 0.0], [1.0, 0.0, 0.0]])
+        scores = predict_scores(regressors, coefficients, numpy.array([0.5, 0.5]), numpy.array([True, False]))
+        self.assertEqual(scores.tolist(), [6.5, 7.0])
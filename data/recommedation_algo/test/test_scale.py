@@ -0,0 +1,67 @@
+from recommedation_algo.scale import UserScale
+from recommedation_algo.test.test_recommender import InMemoryDatabaseHandler, generate_ratings
+
+import numpy
+import unittest
+
+
+class TestUserScale(unittest.TestCase):
+
+    def setUp(self):
+        self.db = InMemoryDatabaseHandler(*generate_ratings())
+        UserScale(1, self.db)
+
+        # a movie rated by every source that user 1 did not rate yet
+        self.movie_id = next(movie_id for movie_id, scores in sorted(self.db.public_ratings.items())
+                             if None not in scores and movie_id not in self.db.user_ratings[1])
+        # and one they rated
+        self.rated = next(movie_id for movie_id in sorted(self.db.user_ratings[1])
+                          if None not in self.db.public_ratings[movie_id])
+
+    def assertFitted(self, scale):
+        fitted = UserScale(1, InMemoryDatabaseHandler(self.db.user_ratings, self.db.public_ratings, {}))
+        self.assertTrue(numpy.allclose(scale.coefficients, fitted.coefficients))
+        self.assertAlmostEqual(scale.intercept, fitted.intercept)
+
+    def test_add_rating(self):
+        version = self.db.rate(1, self.movie_id, 7.0)
+        scale = UserScale(1, self.db, (self.movie_id, 7.0, None, version))
+
+        self.assertEqual(self.db.calls['get_scale_training_data'], 1)  # updated without fitting again
+        self.assertEqual(self.db.scale_statistics[1]['version'], version)
+        self.assertFitted(scale)
+
+        UserScale(1, self.db, (self.movie_id, 7.0, None, version))  # notified twice, counted once
+        self.assertEqual(self.db.scale_statistics[1]['version'], version)
+        self.assertFitted(UserScale(1, self.db))
+        self.assertEqual(self.db.calls['get_scale_training_data'], 1)
+
+    def test_update_and_remove_rating(self):
+        old_score = self.db.user_ratings[1][self.rated]
+
+        version = self.db.rate(1, self.rated, 1.0)
+        self.assertFitted(UserScale(1, self.db, (self.rated, 1.0, old_score, version)))
+
+        version = self.db.rate(1, self.rated, None)
+        self.assertFitted(UserScale(1, self.db, (self.rated, None, 1.0, version)))
+        self.assertEqual(self.db.calls['get_scale_training_data'], 1)
+
+    def test_add_rating_after_other_changes(self):
+        self.db.rate(1, next(iter(self.db.user_ratings[1])), 1.0)  # not notified
+        version = self.db.rate(1, self.movie_id, 7.0)
+        scale = UserScale(1, self.db, (self.movie_id, 7.0, None, version))
+
+        self.assertEqual(self.db.calls['get_scale_training_data'], 2)
+        self.assertFitted(scale)
+
+    def test_add_rating_after_public_ratings_changed(self):
+        self.db.set_public_scores(self.rated, [1.0, 2.0, 1.5])
+        version = self.db.rate(1, self.movie_id, 7.0)
+        scale = UserScale(1, self.db, (self.movie_id, 7.0, None, version))
+
+        self.assertEqual(self.db.calls['get_scale_training_data'], 2)
+        self.assertFitted(scale)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+from recommedation_algo.benchmark import InMemoryDatabaseHandler, generate_catalog
+from recommedation_algo.index import InvertedIndex
+from recommedation_algo.similarity import MovieSimilarity
+from unittest import mock
+
+import multiprocessing
+import unittest
+
+
+class SharedDatabaseHandler(InMemoryDatabaseHandler):
+    """
+        in-memory handler whose neighbour lists are shared with the
+        forked shard workers
+    """
+
+    def __init__(self, history, movie_pool, manager):
+        super().__init__(history, movie_pool)
+        self.neighbour_lists = manager.dict()
+
+    def get_all_neighbour_lists(self):
+        return dict(self.neighbour_lists.items())
+
+
+class TestMovieSimilarity(unittest.TestCase):
+
+    TOP_K = 10
+
+    def setUp(self):
+        self.catalog = generate_catalog(300)
+        self.history = self.catalog[::5]
+
+    def calculate(self, db, **options):
+        MovieSimilarity(db).calculate_similarity_table(top_k=self.TOP_K, **options)
+        return db.neighbour_lists
+
+    def assertSameNeighbours(self, neighbour_lists, expected):
+        self.assertEqual(set(neighbour_lists), set(expected))
+        for movie_id, (neighbour_ids, scores) in expected.items():
+            self.assertEqual(neighbour_lists[movie_id][0], neighbour_ids)
+            for score, expected_score in zip(neighbour_lists[movie_id][1], scores):
+                self.assertAlmostEqual(score, expected_score)
+
+    def test_incremental_runs_match_a_full_run(self):
+        expected = self.calculate(InMemoryDatabaseHandler(self.history, self.catalog))
+
+        # the first run sees part of the histories and of the pool, the second one everything
+        db = InMemoryDatabaseHandler(self.history[:40], self.catalog[:200])
+        self.calculate(db, incremental=True)
+        db.history, db.movie_pool = self.history, self.catalog
+        self.assertSameNeighbours(self.calculate(db, incremental=True), expected)
+
+        written_rows = db.written_rows
+        self.calculate(db, incremental=True)  # nothing new to score
+        self.assertEqual(db.written_rows, written_rows)
+
+    def test_pruned_pairs_match_all_pairs(self):
+        expected = self.calculate(InMemoryDatabaseHandler(self.history, self.catalog), min_score=0.5)
+        self.assertTrue(expected)
+
+        with mock.patch.object(InvertedIndex, 'DENSE_FRACTION', 1.0):
+            pruned = self.calculate(InMemoryDatabaseHandler(self.history, self.catalog), min_score=0.5)
+        self.assertSameNeighbours(pruned, expected)
+
+    def test_shards_match_a_single_process(self):
+        expected = self.calculate(InMemoryDatabaseHandler(self.history, self.catalog))
+
+        with multiprocessing.Manager() as manager:
+            db = SharedDatabaseHandler(self.history, self.catalog, manager)
+            MovieSimilarity(db, lambda: db).calculate_similarity_table(top_k=self.TOP_K, workers=2)
+            self.assertSameNeighbours(db.get_all_neighbour_lists(), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+from recommedation_algo.store import NeighbourStore
+
+import os
+import tempfile
+import unittest
+
+
+class TestNeighbourStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'store')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_get_neighbours(self):
+        NeighbourStore.publish({
+            'tt3': (['tt1', 'tt2'], [0.9, 0.3]),
+            'tt1': (['tt4'], [0.5])
+        }, self.path)
+        store = NeighbourStore(self.path)
+
+        self.assertEqual(store.get_neighbours(['tt3']), {'tt1'})
+        self.assertEqual(store.get_neighbours(['tt3'], threshold=0.2), {'tt1', 'tt2'})
+        self.assertEqual(store.get_neighbours(['tt1', 'tt3', 'tt9', 'tt12345678']), {'tt1', 'tt4'})
+        self.assertEqual(store.get_neighbours(['tt4']), set())
+
+    def test_refresh_after_publish(self):
+        store = NeighbourStore(self.path)
+        self.assertEqual(store.get_neighbours(['tt1']), set())
+
+        NeighbourStore.publish({'tt1': (['tt2'], [0.8])}, self.path)
+        self.assertTrue(store.refresh())
+        self.assertEqual(store.get_neighbours(['tt1']), {'tt2'})
+
+        NeighbourStore.publish({'tt1': (['tt3'], [0.8])}, self.path)
+        NeighbourStore.publish({'tt1': (['tt5'], [0.8])}, self.path)
+        store.refresh()
+        self.assertEqual(store.get_neighbours(['tt1']), {'tt5'})
+        self.assertEqual(len([entry for entry in os.listdir(self.path) if entry != 'current']), 2)